@@ -0,0 +1,347 @@
+"""
+Нагрузочный тест полного диалога расчёта.
+
+N симулированных пользователей параллельно проходят /start -> регион -> возраст ->
+двигатель -> объём -> мощность -> цена через диспетчер с зарегистрированными
+хендлерами. calcus.ru, API курсов и Bot API заменены локальными заглушками
+(bench/stubs.py) в отдельном процессе. Отчёт: пропускная способность,
+p50/p95/p99 времени обработки каждого шага, максимальная задержка цикла событий
+и прирост памяти процесса. Результат сравнивается с сохранённым эталоном,
+при регрессии скрипт завершается с кодом 1.
+
+Запуск:
+    python bench/bench_dialog.py --users 500 --concurrency 100
+    python bench/bench_dialog.py --save-baseline
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.join(os.path.dirname(BENCH_DIR), "bot")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+BENCH_TOKEN = "123456:bench-token-ABCDEFGHIJKLMNOPQRSTUV"
+
+# Шаги диалога и текст, который отправляет пользователь на каждом из них
+FLOW = [
+    ("start", "/start"),
+    ("region", "Китай"),
+    ("age", "до 3"),
+    ("engine_type", "Бензиновый"),
+    ("engine_capacity", "1998"),
+    ("engine_power", "150"),
+    ("price", "{price}"),
+]
+# Начало ответа с расчётом; иной последний ответ потока (ошибка расчёта,
+# исчерпанный лимит) считается неудавшимся расчётом
+QUOTE_REPLY_PREFIX = "Результаты расчёта:"
+
+
+def make_update(update_id: int, user_id: int, text: str) -> Dict:
+    """JSON обновления Telegram с текстовым сообщением пользователя в личном чате."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def rss_bytes() -> int:
+    """Текущий RSS процесса (на Linux), иначе максимальный RSS."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoopLagMonitor:
+    """Измеряет, насколько позже запланированного просыпается цикл событий."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def start_stubs(args) -> multiprocessing.Process:
+    from stubs import serve, StubConfig
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(target=serve, args=(args.stub_port,), kwargs={
+        "calcus": StubConfig(args.calcus_latency, args.calcus_jitter, args.calcus_error_rate),
+        "rates": StubConfig(args.rates_latency, 0, args.rates_error_rate),
+        "telegram": StubConfig(args.telegram_latency),
+        "replay": getattr(args, "replay", None),
+    }, daemon=True)
+    process.start()
+    return process
+
+
+async def wait_for_stubs(port: int, timeout: float = 10):
+    import aiohttp
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/stats") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.1)
+
+
+async def fetch_stub_counters(port: int) -> Dict:
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/stats") as response:
+            return await response.json()
+
+
+def configure_environment(args):
+    """Направляет бота на заглушки; вызывается до импорта модулей бота."""
+    base = f"http://127.0.0.1:{args.stub_port}"
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_API_URL": base,
+        "CALCUS_BASE_URL": f"{base}/calcus",
+        "RATES_API_URL": f"{base}/rates",
+        "FSM_STORAGE": args.fsm_storage,
+        # Заглушка Bot API не ограничивает частоту, лимиты Telegram здесь не нужны
+        "SEND_GLOBAL_RATE": "0",
+        "SEND_CHAT_RATE": "0",
+    })
+    # Базы и файлы бота создаются во временном каталоге, чтобы не трогать рабочие
+    os.chdir(tempfile.mkdtemp(prefix="bench-"))
+    sys.path.insert(0, BOT_DIR)
+
+
+async def simulate_user(dp, user_id: int, price: int, latencies: Dict[str, List[float]],
+                        errors: List[str], think_time: float):
+    from aiogram import types
+    for step, text in FLOW:
+        update = types.Update(**make_update(user_id * 100 + len(latencies[step]), user_id,
+                                            text.format(price=price)))
+        started = time.perf_counter()
+        try:
+            # Каждое обновление в отдельной задаче, как при polling: фильтры aiogram
+            # кэшируют состояние FSM в contextvars
+            await asyncio.ensure_future(dp.process_update(update))
+        except Exception as e:
+            errors.append(f"{step}: {e!r}")
+        latencies[step].append(time.perf_counter() - started)
+        if think_time:
+            await asyncio.sleep(think_time)
+
+
+async def run_benchmark(args) -> Dict:
+    from aiogram import Bot, Dispatcher
+    from bot import create_dispatcher, on_startup, on_shutdown
+    from sender import outbox
+
+    await wait_for_stubs(args.stub_port)
+    dp = create_dispatcher()
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+
+    latencies: Dict[str, List[float]] = {step: [] for step, _ in FLOW}
+    errors: List[str] = []
+    # Последний текст, отправленный ботом в чат: по нему видно, чем закончился поток
+    last_replies: Dict[int, str] = {}
+    submit = outbox.submit
+
+    def recording_submit(chat_id, method, *args, **kwargs):
+        if method == "send_message":
+            last_replies[chat_id] = kwargs.get("text", "")
+        return submit(chat_id, method, *args, **kwargs)
+
+    outbox.submit = recording_submit
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id: int):
+        async with semaphore:
+            price = 150000 + (user_id % args.configs) * 1000
+            await simulate_user(dp, user_id, price, latencies, errors, args.think_time)
+
+    monitor = LoopLagMonitor()
+    rss_before = rss_bytes()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(1000 + i) for i in range(args.users)))
+    # Хендлеры только ставят ответы в очередь: ждём их доставки
+    await outbox.drain()
+    duration = time.perf_counter() - started
+    outbox.submit = submit
+    await monitor.stop()
+    rss_after = rss_bytes()
+    counters = await fetch_stub_counters(args.stub_port)
+
+    await on_shutdown(dp)
+    await dp.storage.close()
+    await (await dp.bot.get_session()).close()
+
+    updates = sum(len(values) for values in latencies.values())
+    replies = [last_replies.get(1000 + i, "") for i in range(args.users)]
+    failed = [reply for reply in replies if not reply.startswith(QUOTE_REPLY_PREFIX)]
+    quoted = args.users - len(failed)
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "duration": duration,
+        # В пропускную способность идут только потоки, закончившиеся расчётом
+        "flows_per_second": quoted / duration,
+        "updates_per_second": updates / duration,
+        "steps": {
+            step: {
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": max(values) if values else 0.0,
+            }
+            for step, values in latencies.items()
+        },
+        "loop_lag_p99": percentile(monitor.samples, 99),
+        "loop_lag_max": monitor.max_lag,
+        "rss_growth": rss_after - rss_before,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "failed_quotes": len(failed),
+        "failed_samples": sorted(set(failed))[:5],
+        "upstream_calls": counters,
+    }
+
+
+def compare_with_baseline(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Список регрессий: неудачные расчёты сверх эталона, шаги, у которых p95 вырос,
+    и падение пропускной способности (по успешным расчётам) больше допуска.
+    """
+    regressions = []
+    if result["failed_quotes"] > baseline.get("failed_quotes", 0):
+        regressions.append(f"неудачных расчётов {result['failed_quotes']} > {baseline.get('failed_quotes', 0)}")
+    if result["flows_per_second"] < baseline["flows_per_second"] * (1 - tolerance):
+        regressions.append(f"пропускная способность {result['flows_per_second']:.1f} < "
+                           f"{baseline['flows_per_second']:.1f} потоков/с")
+    for step, stats in result["steps"].items():
+        base = baseline["steps"].get(step)
+        # Небольшие абсолютные значения (меньше 5 мс) не считаются регрессией
+        if base and stats["p95"] > max(base["p95"] * (1 + tolerance), base["p95"] + 0.005):
+            regressions.append(f"{step}: p95 {stats['p95'] * 1000:.1f} мс > {base['p95'] * 1000:.1f} мс")
+    if result["loop_lag_max"] > max(baseline["loop_lag_max"] * (1 + tolerance), 0.05):
+        regressions.append(f"задержка цикла событий {result['loop_lag_max'] * 1000:.1f} мс > "
+                           f"{baseline['loop_lag_max'] * 1000:.1f} мс")
+    return regressions
+
+
+def print_report(result: Dict):
+    print(f"Пользователей: {result['users']}, параллельно: {result['concurrency']}, "
+          f"время: {result['duration']:.2f} с")
+    print(f"Пропускная способность: {result['flows_per_second']:.1f} расчётов/с, "
+          f"{result['updates_per_second']:.1f} обновлений/с")
+    print(f"{'шаг':<16}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for step, stats in result["steps"].items():
+        print(f"{step:<16}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}"
+              f"{stats['p99'] * 1000:>10.1f}{stats['max'] * 1000:>10.1f}")
+    print(f"Задержка цикла событий: p99 {result['loop_lag_p99'] * 1000:.1f} мс, "
+          f"max {result['loop_lag_max'] * 1000:.1f} мс")
+    print(f"Прирост RSS: {result['rss_growth'] / 1024 / 1024:.1f} МБ")
+    print(f"Вызовы заглушек: {result['upstream_calls']}, ошибок: {result['errors']}")
+    for sample in result["error_samples"]:
+        print(f"  {sample}")
+    print(f"Неудачных расчётов: {result['failed_quotes']} из {result['users']}")
+    for sample in result["failed_samples"]:
+        print(f"  {sample!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест диалога расчёта")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--configs", type=int, default=50, help="число различных цен (влияет на попадания в кэш)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между шагами, с")
+    parser.add_argument("--fsm-storage", default="memory", choices=["memory", "sqlite"])
+    parser.add_argument("--stub-port", type=int, default=8099)
+    parser.add_argument("--calcus-latency", type=float, default=0.3)
+    parser.add_argument("--calcus-jitter", type=float, default=0.1)
+    parser.add_argument("--calcus-error-rate", type=float, default=0.0)
+    parser.add_argument("--rates-latency", type=float, default=0.2)
+    parser.add_argument("--rates-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    args = parser.parse_args()
+
+    args.baseline = os.path.abspath(args.baseline)
+    args.json = args.json and os.path.abspath(args.json)
+    stubs = start_stubs(args)
+    configure_environment(args)
+    try:
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        stubs.terminate()
+
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Эталон сохранён: {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(result, json.load(f), args.tolerance)
+        if regressions:
+            print("Регрессии относительно эталона:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("Регрессий относительно эталона нет")
+
+
+if __name__ == "__main__":
+    main()
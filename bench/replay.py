@@ -0,0 +1,285 @@
+"""
+Воспроизведение записанного трафика (bot/traffic_recorder.py) для оценки запаса мощности.
+
+Записанные сообщения подаются в диспетчер с зарегистрированными хендлерами с
+исходными интервалами, ускоренными в 1, 10, 100... раз. Ответы calcus.ru и курсы
+отдают заглушки (bench/stubs.py) из той же записи с записанной задержкой; запросы,
+которых нет в записи, получают синтетический ответ. Каждая скорость прогоняется
+в отдельном процессе с чистыми базами, так что дневные лимиты и кэши не переносятся
+между прогонами.
+
+Сообщения одного пользователя обрабатываются строго по очереди, как в одном
+воркере; время, которое сообщение ждёт предыдущее сообщение того же пользователя,
+показывает конкуренцию за его состояние FSM. Отчёт: предложенная и достигнутая
+нагрузка, отставание подачи от расписания (насыщение цикла событий), время
+ответа, задержка хендлеров, ожидание своей очереди пользователем, время операций
+SQLite (счётчики, FSM, журнал расчётов) и задержка цикла событий.
+
+Запуск:
+    python bench/replay.py traffic.jsonl --speeds 1 10 100
+    python bench/replay.py traffic.jsonl --speeds 10 --fsm-storage sqlite --save-baseline
+Параметры бота (размер кэша, CALCUS_MAX_CONCURRENCY и т. п.) задаются переменными окружения.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from queue import Empty
+from typing import Dict, List
+
+from bench_dialog import (BENCH_DIR, LoopLagMonitor, configure_environment, fetch_stub_counters,
+                          make_update, percentile, start_stubs, wait_for_stubs)
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "replay_baseline.json")
+# Прогон считается насыщенным, если p95 отставания подачи от расписания больше SATURATION_LAG
+# секунд или обработано меньше SATURATION_RATIO от предложенной нагрузки
+SATURATION_LAG = 0.1
+SATURATION_RATIO = 0.9
+# Пользователи из записи получают id начиная с этого значения
+USER_ID_OFFSET = 1
+
+
+def load_updates(paths: List[str]) -> List[Dict]:
+    """Сообщения из файлов записи по времени; t — секунды от первого сообщения."""
+    updates = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    event = json.loads(line)
+                    if event["kind"] == "update":
+                        updates.append(event)
+    updates.sort(key=lambda event: event["t"])
+    if updates:
+        start = updates[0]["t"]
+        for event in updates:
+            event["t"] -= start
+    return updates
+
+
+def _summary(values: List[float]) -> Dict:
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95),
+            "p99": percentile(values, 99), "max": max(values) if values else 0.0}
+
+
+async def replay(args, speed: float, updates: List[Dict]) -> Dict:
+    from aiogram import Bot, Dispatcher, types
+    from bot import create_dispatcher, on_startup, on_shutdown
+    from metrics import HANDLER_LATENCY, SQLITE_LATENCY, SEND_LATENCY
+    from sender import outbox
+    from startup import warmup
+
+    await wait_for_stubs(args.stub_port)
+    counters_before = await fetch_stub_counters(args.stub_port)
+    dp = create_dispatcher()
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    await warmup.wait_ready()
+
+    schedule_lag: List[float] = []
+    response: List[float] = []
+    user_wait: List[float] = []
+    errors: List[str] = []
+    last: Dict[int, asyncio.Future] = {}
+
+    async def handle(index: int, event: Dict, previous, due: float):
+        if previous is not None and not previous.done():
+            waited = time.perf_counter()
+            await asyncio.wait([previous])
+            user_wait.append(time.perf_counter() - waited)
+        update = types.Update(**make_update(index + 1, USER_ID_OFFSET + event["user"], event["text"]))
+        try:
+            # Отдельная задача на обновление, как при polling: фильтры aiogram кэшируют состояние FSM
+            await asyncio.ensure_future(dp.process_update(update))
+        except Exception as e:
+            errors.append(f"{event['text']!r}: {e!r}")
+        response.append(time.perf_counter() - due)
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    for index, event in enumerate(updates):
+        due = started + event["t"] / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        schedule_lag.append(max(0.0, time.perf_counter() - due))
+        user = event["user"]
+        last[user] = asyncio.ensure_future(handle(index, event, last.get(user), due))
+    await asyncio.gather(*last.values())
+    # Хендлеры только ставят ответы в очередь: ждём их доставки
+    await outbox.drain()
+    duration = time.perf_counter() - started
+    await monitor.stop()
+    counters = await fetch_stub_counters(args.stub_port)
+
+    await on_shutdown(dp)
+    await dp.storage.close()
+    await (await dp.bot.get_session()).close()
+
+    span = updates[-1]["t"] / speed if updates else 0.0
+    offered = len(updates) / span if span else float("inf")
+    achieved = len(updates) / duration if duration else 0.0
+    lag = _summary(schedule_lag)
+    handlers = {}
+    for (handler, state), stats in sorted(HANDLER_LATENCY.summary().items()):
+        handlers[f"{handler} [{state}]"] = {"count": stats["count"], "p50": stats["p50"], "p95": stats["p95"]}
+    return {
+        "speed": speed,
+        "updates": len(updates),
+        "users": len(last),
+        "duration": duration,
+        "offered_per_second": offered,
+        "achieved_per_second": achieved,
+        "saturated": lag["p95"] > SATURATION_LAG or achieved < offered * SATURATION_RATIO,
+        "schedule_lag": lag,
+        "response": _summary(response),
+        "handlers": handlers,
+        "user_wait": dict(_summary(user_wait), count=len(user_wait)),
+        "sqlite": {operation: {"count": stats["count"], "p95": stats["p95"]}
+                   for (operation,), stats in sorted(SQLITE_LATENCY.summary().items())},
+        "send_p95": max((stats["p95"] for stats in SEND_LATENCY.summary().values()), default=0.0),
+        "loop_lag_p99": percentile(monitor.samples, 99),
+        "loop_lag_max": monitor.max_lag,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "upstream_calls": {name: counters[name] - counters_before.get(name, 0) for name in counters},
+    }
+
+
+def _run_speed(args, speed: float, results: multiprocessing.Queue):
+    """Точка входа процесса одного прогона: свои временный каталог, базы и метрики."""
+    configure_environment(args)
+    updates = load_updates(args.recordings)
+    if args.max_updates:
+        updates = updates[:args.max_updates]
+    results.put(asyncio.run(replay(args, speed, updates)))
+
+
+def compare_with_baseline(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Регрессии на одной скорости: рост p95 времени ответа и хендлеров, падение достигнутой нагрузки."""
+    regressions = []
+    prefix = f"x{result['speed']:g}"
+    if result["achieved_per_second"] < baseline["achieved_per_second"] * (1 - tolerance):
+        regressions.append(f"{prefix}: нагрузка {result['achieved_per_second']:.1f} < "
+                           f"{baseline['achieved_per_second']:.1f} обновлений/с")
+    # Небольшие абсолютные значения (меньше 5 мс) не считаются регрессией
+    if result["response"]["p95"] > max(baseline["response"]["p95"] * (1 + tolerance),
+                                       baseline["response"]["p95"] + 0.005):
+        regressions.append(f"{prefix}: p95 ответа {result['response']['p95'] * 1000:.1f} мс > "
+                           f"{baseline['response']['p95'] * 1000:.1f} мс")
+    for handler, stats in result["handlers"].items():
+        base = baseline["handlers"].get(handler)
+        if base and stats["p95"] > max(base["p95"] * (1 + tolerance), base["p95"] + 0.005):
+            regressions.append(f"{prefix} {handler}: p95 {stats['p95'] * 1000:.1f} мс > "
+                               f"{base['p95'] * 1000:.1f} мс")
+    return regressions
+
+
+def _ms(value: float) -> str:
+    return f"{value * 1000:.1f}"
+
+
+def print_report(results: List[Dict]):
+    for result in results:
+        print(f"=== x{result['speed']:g}: {result['updates']} сообщений, {result['users']} пользователей, "
+              f"{result['duration']:.2f} с{' — НАСЫЩЕНИЕ' if result['saturated'] else ''}")
+        print(f"Нагрузка: предложено {result['offered_per_second']:.1f}/с, "
+              f"обработано {result['achieved_per_second']:.1f}/с")
+        for name, title in (("schedule_lag", "Отставание от расписания"), ("response", "Время ответа"),
+                            ("user_wait", "Ожидание своей очереди")):
+            stats = result[name]
+            print(f"{title}: p50 {_ms(stats['p50'])}, p95 {_ms(stats['p95'])}, "
+                  f"p99 {_ms(stats['p99'])}, max {_ms(stats['max'])} мс")
+        print(f"Сообщений, ждавших предыдущее сообщение пользователя: {result['user_wait']['count']}")
+        print("Хендлеры (кол-во, p50, p95, мс):")
+        for handler, stats in result["handlers"].items():
+            print(f"  {handler}: {stats['count']}, {_ms(stats['p50'])}, {_ms(stats['p95'])}")
+        if result["sqlite"]:
+            print("SQLite (кол-во, p95, мс): " + ", ".join(
+                f"{operation} {stats['count']}/{_ms(stats['p95'])}" for operation, stats in result["sqlite"].items()))
+        print(f"Отправка в Telegram p95: {_ms(result['send_p95'])} мс; задержка цикла событий: "
+              f"p99 {_ms(result['loop_lag_p99'])}, max {_ms(result['loop_lag_max'])} мс")
+        print(f"Вызовы заглушек: {result['upstream_calls']}, ошибок: {result['errors']}")
+        for sample in result["error_samples"]:
+            print(f"  {sample}")
+    sustained = [result for result in results if not result["saturated"]]
+    if sustained:
+        best = max(sustained, key=lambda result: result["speed"])
+        print(f"Без насыщения до x{best['speed']:g} ({best['achieved_per_second']:.1f} сообщений/с)")
+    else:
+        print("Насыщение уже на минимальной скорости")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика")
+    parser.add_argument("recordings", nargs="+", help="файлы записи (TRAFFIC_RECORD_FILE)")
+    parser.add_argument("--speeds", type=float, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--max-updates", type=int, default=0, help="воспроизвести только первые N сообщений")
+    parser.add_argument("--fsm-storage", default="memory", choices=["memory", "sqlite"])
+    parser.add_argument("--stub-port", type=int, default=8099)
+    parser.add_argument("--calcus-latency", type=float, default=0.3, help="для запросов, которых нет в записи")
+    parser.add_argument("--calcus-jitter", type=float, default=0.1)
+    parser.add_argument("--calcus-error-rate", type=float, default=0.0)
+    parser.add_argument("--rates-latency", type=float, default=0.2)
+    parser.add_argument("--rates-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    args = parser.parse_args()
+
+    args.recordings = [os.path.abspath(path) for path in args.recordings]
+    args.baseline = os.path.abspath(args.baseline)
+    args.json = args.json and os.path.abspath(args.json)
+    args.replay = args.recordings
+    stubs = start_stubs(args)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for speed in args.speeds:
+            queue = context.Queue()
+            process = context.Process(target=_run_speed, args=(args, speed, queue))
+            process.start()
+            while True:
+                try:
+                    results.append(queue.get(timeout=1))
+                    break
+                except Empty:
+                    if not process.is_alive():
+                        sys.exit(f"Прогон x{speed:g} завершился с кодом {process.exitcode}")
+            process.join()
+    finally:
+        stubs.terminate()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Эталон сохранён: {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = {result["speed"]: result for result in json.load(f)}
+        regressions = []
+        for result in results:
+            if result["speed"] in baseline:
+                regressions.extend(compare_with_baseline(result, baseline[result["speed"]], args.tolerance))
+        if regressions:
+            print("Регрессии относительно эталона:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("Регрессий относительно эталона нет")
+
+
+if __name__ == "__main__":
+    main()
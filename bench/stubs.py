@@ -0,0 +1,186 @@
+"""
+Локальные заглушки внешних сервисов для нагрузочных тестов.
+
+Один HTTP-сервер отвечает на /calcus как calcus.ru, на /rates как
+open.exchangerate-api.com и на /bot<token>/<method> как Bot API (getMe,
+sendMessage и прочие методы отправки). Для каждого сервиса настраиваются
+задержка и доля ошибок. С записью трафика (--replay, см. bot/traffic_recorder.py)
+calcus и курсы отвечают записанными ответами с записанной задержкой.
+
+Запуск отдельно:
+    python bench/stubs.py --port 8081 --calcus-latency 0.3 --calcus-error-rate 0.01
+    python bench/stubs.py --port 8081 --replay traffic.jsonl
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from aiohttp import web
+
+
+class StubConfig:
+    """Задержка (секунды, с разбросом jitter) и доля ответов 500 для одного сервиса."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    async def delay(self):
+        pause = self.latency + random.uniform(0, self.jitter)
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+
+def fake_calcus_result(params: Dict) -> Dict:
+    """Правдоподобный результат расчёта: пошлина пропорциональна цене и объёму."""
+    price = float(params.get("price") or 0) * {"CNY": 11.0, "KRW": 0.06}.get(params.get("curr"), 1.0)
+    capacity = float(params.get("value") or 0)
+    sbor = 11746
+    tax = max(price * 0.48, capacity * 5.5 * 92)
+    util = 3400 if params.get("age") == "0-3" else 5200
+    total = sbor + tax + util
+    return {"sbor": sbor, "tax": round(tax, 2), "util": util, "total": round(total, 2),
+            "total2": round(total + price, 2)}
+
+
+FAKE_RATES = {"USD": 1, "RUB": 80.0, "CNY": 7.2, "EUR": 0.92, "KRW": 1380.0}
+
+
+def calcus_key(params: Dict) -> str:
+    """Ключ запроса к calcus: 150 и 150.0 дают один ключ."""
+    normalized = {key: int(value) if isinstance(value, float) and value.is_integer() else value
+                  for key, value in params.items()}
+    return json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+
+
+class RecordedResponses:
+    """
+    Ответы calcus и последние курсы из записи трафика. На повторяющийся запрос ответы
+    отдаются по кругу в записанном порядке, каждый со своей задержкой.
+    """
+
+    def __init__(self, events: Iterable[Dict]):
+        calcus: Dict[str, List[Tuple[Optional[Dict], float]]] = {}
+        self.rates: Optional[Dict] = None
+        for event in events:
+            if event["kind"] == "calcus":
+                calcus.setdefault(calcus_key(event["params"]), []).append((event["result"], event["latency"]))
+            elif event["kind"] == "rates":
+                self.rates = self._api_rates(event["rub"])
+        self.calcus = {key: itertools.cycle(responses) for key, responses in calcus.items()}
+
+    @staticmethod
+    def _api_rates(rub: Dict) -> Dict:
+        # В записи курсы к рублю, API отдаёт курсы относительно доллара
+        rub_per_usd = rub["USD"]
+        rates = {currency: rub_per_usd / value for currency, value in rub.items()}
+        rates["USD"] = 1
+        return rates
+
+    @classmethod
+    def load(cls, paths: Iterable[str]) -> "RecordedResponses":
+        events = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+        events.sort(key=lambda event: event["t"])
+        return cls(events)
+
+    def calcus_response(self, params: Dict) -> Optional[Tuple[Optional[Dict], float]]:
+        responses = self.calcus.get(calcus_key(params))
+        return next(responses) if responses is not None else None
+
+
+class StubServer:
+    """HTTP-сервер со всеми заглушками; пути: /calcus, /rates, /bot<token>/<method>."""
+
+    def __init__(self, calcus: Optional[StubConfig] = None, rates: Optional[StubConfig] = None,
+                 telegram: Optional[StubConfig] = None, recorded: Optional[RecordedResponses] = None):
+        self.calcus = calcus or StubConfig()
+        self.rates = rates or StubConfig()
+        self.telegram = telegram or StubConfig()
+        self.recorded = recorded
+        self.counters = {"calcus": 0, "rates": 0, "telegram": 0, "calcus_recorded": 0}
+        self._message_id = 0
+
+    async def handle_calcus(self, request: web.Request) -> web.Response:
+        self.counters["calcus"] += 1
+        params = await request.json()
+        response = self.recorded.calcus_response(params) if self.recorded else None
+        if response is not None:
+            self.counters["calcus_recorded"] += 1
+            result, latency = response
+            await asyncio.sleep(latency)
+            if not result:
+                return web.json_response({"error": "recorded failure"}, status=500)
+            return web.json_response(result)
+        await self.calcus.delay()
+        if self.calcus.fails():
+            return web.json_response({"error": "stub failure"}, status=500)
+        return web.json_response(fake_calcus_result(params))
+
+    async def handle_rates(self, request: web.Request) -> web.Response:
+        self.counters["rates"] += 1
+        await self.rates.delay()
+        if self.rates.fails():
+            return web.json_response({"result": "error"}, status=500)
+        rates = self.recorded.rates if self.recorded and self.recorded.rates else FAKE_RATES
+        return web.json_response({"result": "success", "rates": rates})
+
+    async def handle_telegram(self, request: web.Request) -> web.Response:
+        self.counters["telegram"] += 1
+        method = request.match_info["method"]
+        await self.telegram.delay()
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}})
+        data = await request.post()
+        self._message_id += 1
+        chat_id = int(data.get("chat_id", 0))
+        return web.json_response({"ok": True, "result": {
+            "message_id": self._message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.counters)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/calcus", self.handle_calcus)
+        app.router.add_get("/rates", self.handle_rates)
+        app.router.add_get("/stats", self.handle_stats)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_telegram)
+        return app
+
+
+def serve(port: int, replay: Optional[List[str]] = None, **kwargs):
+    """Запускает сервер заглушек (точка входа для отдельного процесса); replay — файлы записи трафика."""
+    if replay:
+        kwargs["recorded"] = RecordedResponses.load(replay)
+    web.run_app(StubServer(**kwargs).create_app(), host="127.0.0.1", port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушки calcus.ru, курсов валют и Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--calcus-latency", type=float, default=0.3)
+    parser.add_argument("--calcus-jitter", type=float, default=0.1)
+    parser.add_argument("--calcus-error-rate", type=float, default=0.0)
+    parser.add_argument("--rates-latency", type=float, default=0.2)
+    parser.add_argument("--rates-error-rate", type=float, default=0.0)
+    parser.add_argument("--replay", nargs="*", help="файлы записи трафика с ответами calcus и курсами")
+    args = parser.parse_args()
+    serve(args.port, replay=args.replay,
+          calcus=StubConfig(args.calcus_latency, args.calcus_jitter, args.calcus_error_rate),
+          rates=StubConfig(args.rates_latency, 0, args.rates_error_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,70 @@
+import asyncio
+import json
 import logging
-import requests
+import aiohttp
 import os
-from typing import Dict, Optional
-logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+import time
+from typing import Callable, Dict, Optional
+from metrics import UPSTREAM_LATENCY
+from resilience import ClientRequestError, SaturatedError
 logger = logging.getLogger(__name__)
 
+
+def map_params(params: Dict) -> Dict:
+    """
+    Преобразует параметры из формата бота в формат, ожидаемый API.
+
+    Args:
+        params: Параметры в формате бота (country_from, vehicle_type, vehicle_price, etc.).
+
+    Returns:
+        Словарь с параметрами в формате API.
+    """
+    # Маппинг engine_type
+    engine_map = {
+        "gasoline": 1,
+        "diesel": 2,
+        "hybrid": 3,
+        "electric": 4
+    }
+
+    # Маппинг vehicle_age
+    age_map = {
+        "до 3": "0-3",
+        "3-5": "3-5"
+    }
+
+    api_params = {
+        "owner": 1,  # Физическое лицо для личного использования
+        "age": age_map.get(params.get("vehicle_age"), params.get("vehicle_age")),
+        "engine": engine_map.get(params.get("engine_type")),
+        "power": params.get("engine_power"),
+        "power_unit": 1,  # Лошадиные силы
+        "value": params.get("engine_capacity"),
+        "price": params.get("vehicle_price"),
+        "curr": params.get("currency", "RUB")
+    }
+
+    return api_params
+
+
+def _normalize(value):
+    """Приводит числа к единому виду, чтобы 2000 и 2000.0 давали один ключ."""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def params_key(params: Dict) -> str:
+    """Строковый ключ запроса, построенный по нормализованному результату map_params."""
+    api_params = map_params(params)
+    return json.dumps({key: _normalize(value) for key, value in api_params.items()},
+                      sort_keys=True, ensure_ascii=False)
+
+
 class CalcusAPIClient:
     def __init__(self):
-        self.base_url = "https://calcus.ru/api/v1/Customs"
+        self.base_url = os.getenv("CALCUS_BASE_URL", "https://calcus.ru/api/v1/Customs")
         self.client_id = os.getenv("CALCUS_CLIENT_ID")
         self.api_key = os.getenv("CALCUS_API_KEY")
         self.headers = {
@@ -17,41 +74,8 @@ class CalcusAPIClient:
         }
 
     def _map_params(self, params: Dict) -> Dict:
-        """
-        Преобразует параметры из формата бота в формат, ожидаемый API.
-
-        Args:
-            params: Параметры в формате бота (country_from, vehicle_type, vehicle_price, etc.).
-
-        Returns:
-            Словарь с параметрами в формате API.
-        """
-        # Маппинг engine_type
-        engine_map = {
-            "gasoline": 1,
-            "diesel": 2,
-            "hybrid": 3,
-            "electric": 4
-        }
-
-        # Маппинг vehicle_age
-        age_map = {
-            "до 3": "0-3",
-            "3-5": "3-5"
-        }
-
-        api_params = {
-            "owner": 1,  # Физическое лицо для личного использования
-            "age": age_map.get(params.get("vehicle_age"), params.get("vehicle_age")),
-            "engine": engine_map.get(params.get("engine_type")),
-            "power": params.get("engine_power"),
-            "power_unit": 1,  # Лошадиные силы
-            "value": params.get("engine_capacity"),
-            "price": params.get("vehicle_price"),
-            "curr": params.get("currency", "RUB")
-        }
-
-        return api_params
+        """Преобразует параметры из формата бота в формат, ожидаемый API."""
+        return map_params(params)
 
     def calculate_customs(self, params: Dict) -> Optional[Dict]:
         """
@@ -66,25 +90,174 @@ class CalcusAPIClient:
         Raises:
             requests.exceptions.RequestException: Если запрос не удался.
         """
+        # Синхронный клиент боту не нужен, requests импортируется только при его вызове
+        import requests
+
         # Преобразование параметров
         api_params = self._map_params(params)
 
         try:
-            logger.info(f"Sending request to API with params: {api_params}")
+            logger.debug("Sending request to API with params: %s", api_params)
             response = requests.post(self.base_url, json=api_params, headers=self.headers, timeout=10)
             response.raise_for_status()
             result = response.json()
-            logger.info(f"API response: {result}")
+            logger.debug("API response: %s", result)
             return result
         except requests.exceptions.HTTPError as e:
-            logger.error(f"HTTP error occurred: {e}, Response: {response.text}")
+            logger.error("HTTP error occurred: %s, Response: %s", e, response.text)
             return None
         except requests.exceptions.ConnectionError as e:
-            logger.error(f"Connection error occurred: {e}")
+            logger.error("Connection error occurred: %s", e)
             return None
         except requests.exceptions.Timeout as e:
-            logger.error(f"Request timed out: {e}")
+            logger.error("Request timed out: %s", e)
             return None
         except requests.exceptions.RequestException as e:
-            logger.error(f"Request failed: {e}")
-            return None
\ No newline at end of file
+            logger.error("Request failed: %s", e)
+            return None
+
+
+class AsyncCalcusAPIClient(CalcusAPIClient):
+    """
+    Асинхронный клиент calcus.ru для вызова из хендлеров.
+
+    Использует одну долгоживущую aiohttp-сессию с keep-alive пулом соединений,
+    ограничивает число одновременных запросов и задаёт дедлайн на каждый запрос.
+    Ожидание свободного слота в дедлайн не входит и ограничено отдельно
+    (queue_timeout): не дождавшись слота, запрос завершается SaturatedError.
+    """
+
+    def __init__(self, max_connections: Optional[int] = None, max_concurrency: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 on_response: Optional[Callable[[Dict, Optional[Dict], float], None]] = None):
+        super().__init__()
+        # Вызывается с параметрами API, ответом и временем HTTP-запроса (без ожидания слота)
+        self.on_response = on_response
+        self.max_connections = max_connections or int(os.getenv("CALCUS_MAX_CONNECTIONS", "20"))
+        self.max_concurrency = max_concurrency or int(os.getenv("CALCUS_MAX_CONCURRENCY", "10"))
+        self.timeout = timeout or float(os.getenv("CALCUS_TIMEOUT", "10"))
+        # Сколько запрос может ждать свободного слота, прежде чем получить отказ
+        self.queue_timeout = float(os.getenv("CALCUS_QUEUE_TIMEOUT", "30"))
+        self.keepalive_timeout = float(os.getenv("CALCUS_KEEPALIVE_TIMEOUT", "60"))
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, создавая её при первом обращении."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            # aiohttp не принимает заголовки со значением None (requests их просто пропускает)
+            headers = {key: value for key, value in self.headers.items() if value is not None}
+            self._session = aiohttp.ClientSession(connector=connector, headers=headers)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def _acquire_slot(self, queue_timeout: float) -> asyncio.Semaphore:
+        """
+        Занимает слот для запроса, ожидая не дольше queue_timeout секунд.
+
+        Raises:
+            SaturatedError: Если свободный слот не появился за queue_timeout (при 0 — сразу).
+        """
+        self._get_session()
+        semaphore = self._semaphore
+        if not semaphore.locked():
+            # Слот свободен: acquire завершится без ожидания
+            await semaphore.acquire()
+            return semaphore
+        acquire = asyncio.ensure_future(semaphore.acquire())
+        try:
+            await asyncio.wait({acquire}, timeout=queue_timeout)
+        except asyncio.CancelledError:
+            if acquire.done() and not acquire.cancelled():
+                semaphore.release()
+            acquire.cancel()
+            raise
+        if not acquire.done():
+            acquire.cancel()
+            raise SaturatedError(f"calcus.ru: все {self.max_concurrency} слотов заняты дольше {queue_timeout:.0f} с")
+        return semaphore
+
+    async def _post(self, api_params: Dict) -> Optional[Dict]:
+        session = self._get_session()
+        started = time.perf_counter()
+        async with session.post(self.base_url, json=api_params) as response:
+            client_error = None
+            if response.status >= 400:
+                text = await response.text()
+                logger.error("HTTP error occurred: %s, Response: %s", response.status, text)
+                result = None
+                # 4xx, кроме 429, — ошибка в параметрах: повтор не поможет, сервис исправен
+                if response.status < 500 and response.status != 429:
+                    client_error = ClientRequestError(f"calcus.ru: статус {response.status}")
+            else:
+                result = await response.json(content_type=None)
+        if self.on_response is not None:
+            self.on_response(api_params, result, time.perf_counter() - started)
+        if client_error is not None:
+            raise client_error
+        return result
+
+    async def calculate_customs(self, params: Dict, timeout: Optional[float] = None,
+                                queue_timeout: Optional[float] = None) -> Optional[Dict]:
+        """
+        Асинхронно отправляет запрос к API calcus.ru для расчёта таможенных платежей.
+
+        Args:
+            params: Параметры для API (в формате бота).
+            timeout: Дедлайн запроса в секундах (без ожидания слота); по умолчанию CALCUS_TIMEOUT.
+            queue_timeout: Предел ожидания свободного слота; по умолчанию CALCUS_QUEUE_TIMEOUT.
+
+        Returns:
+            Словарь с результатами расчёта или None в случае ошибки.
+
+        Raises:
+            ClientRequestError: Если calcus.ru отклонил запрос (4xx, кроме 429).
+            SaturatedError: Если запрос не дождался свободного слота; в calcus.ru он не отправлялся.
+        """
+        api_params = self._map_params(params)
+        semaphore = await self._acquire_slot(self.queue_timeout if queue_timeout is None else queue_timeout)
+        started = time.perf_counter()
+        outcome = "error"
+
+        try:
+            logger.debug("Sending request to API with params: %s", api_params)
+            result = await asyncio.wait_for(self._post(api_params), timeout or self.timeout)
+            logger.debug("API response: %s", result)
+            outcome = "ok" if result else "http_error"
+            return result
+        except asyncio.CancelledError:
+            # Проигравший хеджированный запрос или отменённый вызов
+            outcome = "cancelled"
+            raise
+        except ClientRequestError:
+            outcome = "client_error"
+            raise
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.error("Request timed out after %s s", timeout or self.timeout)
+            return None
+        except aiohttp.ClientConnectionError as e:
+            outcome = "connection_error"
+            logger.error("Connection error occurred: %s", e)
+            return None
+        except (aiohttp.ClientError, ValueError) as e:
+            logger.error("Request failed: %s", e)
+            return None
+        finally:
+            semaphore.release()
+            latency = time.perf_counter() - started
+            UPSTREAM_LATENCY.observe(latency, service="calcus", outcome=outcome)
+            logger.info("calcus.ru: %s за %.0f мс", outcome, latency * 1000,
+                        extra={"event": "upstream_call", "service": "calcus", "outcome": outcome, "latency": latency})
+
+    async def close(self):
+        """Закрывает общую сессию и пул соединений."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
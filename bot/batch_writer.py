@@ -0,0 +1,113 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional, Tuple, Type
+from metrics import SQLITE_LATENCY
+from scheduler import run_blocking
+
+
+class BatchWriter:
+    """
+    Пакетная запись накопленных в памяти изменений.
+
+    Подкласс копит изменения в памяти и задаёт:
+      _pending() — есть ли что записывать;
+      _take() — снимок изменений; делается в цикле событий, пока их не меняют хендлеры;
+      _write(batch) — запись снимка на диск;
+      _write_failed(batch, error) — что делать со снимком, если запись не удалась;
+      _written(batch) — учёт успешной записи (необязательно).
+
+    Плановая запись flush_in_background() выполняет _write в потоке ввода-вывода,
+    flush() — сразу, в текущем потоке (при закрытии).
+    """
+
+    # Ошибки записи, после которых снимок передаётся в _write_failed
+    write_errors: Tuple[Type[Exception], ...] = (OSError,)
+    # Метка операции в метрике SQLITE_LATENCY (пусто — запись не замеряется)
+    flush_operation = ""
+
+    def _pending(self) -> bool:
+        raise NotImplementedError
+
+    def _take(self) -> Any:
+        raise NotImplementedError
+
+    def _write(self, batch: Any):
+        raise NotImplementedError
+
+    def _write_failed(self, batch: Any, error: Exception):
+        raise NotImplementedError
+
+    def _written(self, batch: Any):
+        pass
+
+    @contextmanager
+    def _timed(self) -> Iterator[None]:
+        if not self.flush_operation:
+            yield
+            return
+        with SQLITE_LATENCY.time(operation=self.flush_operation):
+            yield
+
+    def flush(self):
+        """Записывает накопленные изменения, не выходя из потока."""
+        if not self._pending():
+            return
+        batch = self._take()
+        try:
+            with self._timed():
+                self._write(batch)
+        except self.write_errors as e:
+            self._write_failed(batch, e)
+            return
+        self._written(batch)
+
+    async def flush_in_background(self):
+        """Как flush(), но запись выполняется в потоке ввода-вывода."""
+        if not self._pending():
+            return
+        await self._write_in_background(self._take())
+
+    async def _write_in_background(self, batch: Any):
+        """Пишет уже снятый снимок в потоке ввода-вывода."""
+        try:
+            with self._timed():
+                await run_blocking(self._write, batch)
+        except self.write_errors as e:
+            self._write_failed(batch, e)
+            return
+        self._written(batch)
+
+
+class SQLiteBatchWriter(BatchWriter):
+    """
+    Пакетная запись в SQLite через постоянное соединение (открывает его подкласс).
+    Соединение используется и из цикла (open, close), и из потока ввода-вывода,
+    поэтому все обращения к нему идут под _lock; _transaction() берёт блокировку
+    и завершает запись commit или rollback.
+    """
+
+    write_errors = (sqlite3.Error,)
+
+    def __init__(self):
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            try:
+                yield self._conn
+                self._conn.commit()
+            except sqlite3.Error:
+                self._conn.rollback()
+                raise
+
+    def _close_connection(self):
+        """Дописывает накопленное и закрывает соединение."""
+        if self._conn is None:
+            return
+        self.flush()
+        with self._lock:
+            self._conn.close()
+        self._conn = None
@@ -1,22 +1,126 @@
-from aiogram import Bot, Dispatcher, executor
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from handlers import register_handlers
-from convector import load_cached_rate
+from startup import warmup
 import os
 from dotenv import load_dotenv
 
+# Переменные окружения читаются модулями при импорте, поэтому .env загружается до них
 load_dotenv()
 
-# Загружаем курс USD/RUB при старте
-load_cached_rate()
+from aiogram import Bot, Dispatcher, executor
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from handlers import register_handlers
+from convector import load_cached_rate, schedule_tasks, schedule_rate_reload, rate_store, rates_resilience
+from scheduler import scheduler
+from usage_tracker import schedule_flush, limiter, init_db
+from fsm_storage import TTLStorage, create_storage, schedule_storage_tasks
+from metrics import MetricsMiddleware, MetricsServer, registry, METRICS_PORT
+from sender import outbox, SEND_GLOBAL_RATE
+from quote_log import quote_log, schedule_quote_log_tasks
+from traffic_recorder import TrafficRecorderMiddleware, create_recorder, schedule_recorder_tasks
+import log_setup
+
+
+def create_dispatcher(primary: bool = True, shard=None) -> Dispatcher:
+    """
+    Создаёт бота и диспетчер с зарегистрированными хендлерами.
+
+    Args:
+        primary: Выполняет ли процесс общие задачи (обновление курса, очистку данных).
+            В режиме webhook с несколькими воркерами их выполняет только один из них.
+        shard: Пара (номер, всего) для воркера, обслуживающего часть пользователей.
+    """
+    api_url = os.getenv("TELEGRAM_API_URL")
+    server = TelegramAPIServer.from_base(api_url) if api_url else TELEGRAM_PRODUCTION
+    bot = Bot(token=os.getenv("BOT_TOKEN"), server=server)
+    dp = Dispatcher(bot, storage=create_storage(shard))
+    dp['primary'] = primary
+    dp['shard'] = shard
+    dp.middleware.setup(log_setup.LogContextMiddleware())
+    dp.middleware.setup(MetricsMiddleware())
+    # Запись создаётся до хендлеров: клиент calcus.ru пишет в неё свои ответы
+    recorder = create_recorder(shard)
+    if recorder is not None:
+        dp.middleware.setup(TrafficRecorderMiddleware(recorder))
+    dp['traffic_recorder'] = recorder
+    register_handlers(dp)
+    return dp
+
+
+async def _refresh_stale_rates():
+    if not rate_store.current().is_fresh():
+        await scheduler.run_now("update_exchange_rate")
+
+
+def _add_warmup_steps(dp: Dispatcher):
+    """
+    Шаги запуска: до приёма обновлений читаются только локальные снимки (курсы из файла,
+    состояния FSM), база счётчиков, кэш расчётов, свежие курсы и сетка — в фоне.
+    """
+    warmup.add("rates_file", load_cached_rate, background=False)
+    if isinstance(dp.storage, TTLStorage):
+        warmup.add("fsm_restore", dp.storage.open, background=False)
+    warmup.add("usage_db", init_db)
+    warmup.add("quote_log", quote_log.open)
+    if dp['primary']:
+        warmup.add("rates_refresh", _refresh_stale_rates)
+    if os.getenv("QUOTE_GRID_SOURCE"):
+        from quote_grid import GridCustomsClient
+        client = dp['calcus_client']
+        if isinstance(client, GridCustomsClient):
+            warmup.add("quote_grid", lambda: client.refresh(dp['primary']))
+
+
+async def on_startup(dp: Dispatcher):
+    _add_warmup_steps(dp)
+    # Обновление курса и очистка данных выполняются в том же цикле событий
+    if dp['primary']:
+        schedule_tasks(scheduler)
+    else:
+        schedule_rate_reload(scheduler)
+    schedule_flush(scheduler)
+    schedule_storage_tasks(scheduler, dp.storage)
+    schedule_quote_log_tasks(scheduler)
+    schedule_recorder_tasks(scheduler)
+    if os.getenv("QUOTE_GRID_SOURCE"):
+        from quote_grid import schedule_grid_tasks
+        schedule_grid_tasks(scheduler, dp['calcus_client'], dp['primary'])
+    scheduler.start()
+    # Общий лимит Telegram делится между воркерами webhook-режима
+    outbox.start(dp.bot, SEND_GLOBAL_RATE / dp['shard'][1] if dp['shard'] else SEND_GLOBAL_RATE)
+    registry.collector("startup", warmup.stats)
+    registry.collector("logging", log_setup.stats)
+    registry.collector("send_queue", outbox.stats)
+    registry.collector("scheduler", scheduler.stats)
+    registry.collector("usage", limiter.stats)
+    registry.collector("quote_log", quote_log.stats)
+    if dp['traffic_recorder'] is not None:
+        registry.collector("traffic_recorder", dp['traffic_recorder'].stats)
+    registry.collector("rates_resilience", rates_resilience.stats)
+    if hasattr(dp.storage, "stats"):
+        registry.collector("fsm", dp.storage.stats)
+    # Каждый воркер webhook-режима отдаёт метрики на своём порту
+    port = METRICS_PORT + dp['shard'][0] if METRICS_PORT and dp['shard'] else METRICS_PORT
+    dp['metrics_server'] = MetricsServer(port, ready=warmup.is_ready)
+    await dp['metrics_server'].start()
+    await warmup.start()
+
 
-# Инициализация бота
-bot = Bot(token=os.getenv("BOT_TOKEN"))
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+async def on_shutdown(dp: Dispatcher):
+    await warmup.stop()
+    await outbox.stop()
+    await dp['metrics_server'].stop()
+    await scheduler.stop()
+    await dp['calcus_client'].close()
+    limiter.close()
+    quote_log.close()
+    if dp['traffic_recorder'] is not None:
+        dp['traffic_recorder'].close()
 
-# Регистрация хендлеров
-register_handlers(dp)
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+    log_setup.setup_logging()
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        from webhook import run_webhook
+        run_webhook()
+    else:
+        dp = create_dispatcher()
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,304 @@
+"""
+Пакетный расчёт: CSV/XLSX-файл со списком автомобилей -> CSV с результатами.
+
+Строки читаются потоково порциями в пуле потоков (разбор XLSX не держит цикл
+событий) и проверяются по тем же правилам, что пошаговый диалог.
+Расчёт идёт параллельно ограниченным числом воркеров, запросы к calcus.ru
+ограничены по частоте общим для всех пакетов ограничителем. Результаты пишутся
+в выходной файл по мере готовности в порядке строк исходного файла.
+
+Запуск из командной строки (из каталога bot/):
+    python bulk_quote.py fleet.xlsx -o fleet_quotes.csv --workers 8 --rate 5
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import logging
+import os
+import sys
+import time
+import zipfile
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional
+from convector import rate_store, load_cached_rate, update_exchange_rate
+from pricing import REGIONS, all_commissions, quote_params
+from quick_quote import validate_quote
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Число одновременных расчётов в одном пакете
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", "8"))
+# Общий лимит запросов пакетных расчётов к API, в секунду (0 — без ограничения)
+BULK_RATE_LIMIT = float(os.getenv("BULK_RATE_LIMIT", "5"))
+# Максимум строк в одном файле и размер файла, байты
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "1000"))
+BULK_MAX_FILE_SIZE = int(os.getenv("BULK_MAX_FILE_SIZE", str(5 * 1024 * 1024)))
+# Как часто сообщать о прогрессе, секунды
+BULK_PROGRESS_INTERVAL = float(os.getenv("BULK_PROGRESS_INTERVAL", "3"))
+# Сколько строк файла читается за одно обращение к пулу потоков
+BULK_READ_CHUNK = int(os.getenv("BULK_READ_CHUNK", "100"))
+
+BULK_EXTENSIONS = (".csv", ".xlsx")
+
+# Столбцы исходного файла в порядке по умолчанию (если в файле нет заголовка)
+COLUMNS = ("region", "age", "engine", "capacity", "power", "price")
+HEADER_ALIASES = {
+    "region": "region", "регион": "region",
+    "age": "age", "возраст": "age",
+    "engine": "engine", "двигатель": "engine", "тип двигателя": "engine",
+    "capacity": "capacity", "объём": "capacity", "объем": "capacity",
+    "power": "power", "мощность": "power",
+    "price": "price", "цена": "price", "стоимость": "price",
+}
+# Комиссия в юанях есть только у части регионов — они и перечислены в заголовке
+CNY_FEE_COLUMN = f"Комиссия ({', '.join(name for name, region in REGIONS.items() if region.cny)})"
+RESULT_COLUMNS = ("Таможенный сбор", "Таможенная пошлина", "Утилизационный сбор", CNY_FEE_COLUMN,
+                  "Комиссия (Россия)", "Итого", "Доставка до", "Ошибка")
+
+# Общий для всех пакетов ограничитель запросов к API
+upstream_limiter = TokenBucket(BULK_RATE_LIMIT)
+
+ProgressCallback = Callable[[Dict], Awaitable[None]]
+
+
+def _read_csv(path: str) -> Iterator[List]:
+    try:
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            try:
+                dialect = csv.Sniffer().sniff(f.read(4096), delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            f.seek(0)
+            yield from csv.reader(f, dialect)
+    except UnicodeDecodeError:
+        raise ValueError("Не удалось прочитать CSV: сохраните файл в кодировке UTF-8.")
+    except csv.Error as e:
+        raise ValueError(f"Не удалось прочитать CSV: {e}.")
+
+
+def _read_xlsx(path: str) -> Iterator[List]:
+    try:
+        import openpyxl
+        from openpyxl.utils.exceptions import InvalidFileException
+    except ImportError:
+        raise ValueError("Для XLSX-файлов нужен пакет openpyxl, пришлите CSV.")
+    from xml.etree.ElementTree import ParseError
+    try:
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield ["" if value is None else value for value in row]
+        finally:
+            workbook.close()
+    # Повреждённый или переименованный файл: не zip, в архиве нет частей книги, битый XML
+    except (zipfile.BadZipFile, InvalidFileException, KeyError, ParseError):
+        raise ValueError("Не удалось прочитать XLSX: файл повреждён или это не книга Excel.")
+
+
+def read_rows(path: str) -> Iterator[List]:
+    """
+    Потоково читает строки CSV (разделитель , ; или табуляция) или первого листа XLSX, пропуская пустые.
+
+    Raises:
+        ValueError: Если файл не удаётся разобрать; текст можно показать пользователю.
+    """
+    reader = _read_xlsx(path) if path.lower().endswith(".xlsx") else _read_csv(path)
+    for row in reader:
+        if any(str(value).strip() for value in row):
+            yield row
+
+
+def _take(rows: Iterator[List], count: int) -> List[List]:
+    """Следующие count строк; выполняется в пуле потоков."""
+    return list(itertools.islice(rows, count))
+
+
+def _column_index(header: List) -> Optional[Dict[str, int]]:
+    """Номера столбцов по заголовку; None, если первая строка — не заголовок."""
+    index = {}
+    for position, title in enumerate(header):
+        name = HEADER_ALIASES.get(str(title).strip().lower())
+        if name is not None:
+            index.setdefault(name, position)
+    if not index:
+        return None
+    missing = [name for name in COLUMNS if name not in index and name != "capacity"]
+    if missing:
+        raise ValueError(f"В файле нет столбцов: {', '.join(missing)}.")
+    return index
+
+
+def _cell(row: List, position: Optional[int]):
+    if position is None or position >= len(row):
+        return ""
+    return row[position]
+
+
+async def price_file(source: str, destination: str, client, workers: int = BULK_WORKERS,
+                     limiter: Optional[TokenBucket] = None, max_rows: int = BULK_MAX_ROWS,
+                     on_progress: Optional[ProgressCallback] = None) -> Dict:
+    """
+    Считает все строки файла source и пишет CSV с результатами в destination.
+
+    В выходном файле исходные столбцы дополнены столбцами RESULT_COLUMNS; строки с
+    ошибкой проверки или расчёта попадают в файл с текстом ошибки. Комиссии считаются
+    один раз на пакет по одному снимку курсов.
+
+    Returns:
+        Статистика пакета: rows, priced, errors, truncated, duration.
+
+    Raises:
+        ValueError: Если файл пуст, не читается или в нём не хватает столбцов.
+    """
+    limiter = limiter or upstream_limiter
+    commissions = all_commissions(rate_store.current())
+    loop = asyncio.get_event_loop()
+    rows = read_rows(source)
+    # Чтение и разбор файла — в пуле потоков, порциями по BULK_READ_CHUNK строк
+    chunk = await loop.run_in_executor(None, _take, rows, BULK_READ_CHUNK)
+    if not chunk:
+        raise ValueError("Файл пуст.")
+    header = chunk[0]
+    columns = _column_index(header)
+    if columns is None:
+        columns = {name: position for position, name in enumerate(COLUMNS)}
+        header = list(COLUMNS)
+    else:
+        chunk = chunk[1:]
+    width = len(header)
+
+    stats = {"rows": 0, "priced": 0, "errors": 0, "truncated": False}
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+    ready: Dict[int, List] = {}
+    next_index = 0
+    started = time.perf_counter()
+
+    async def price_row(row: List) -> List:
+        fields = validate_quote(*(_cell(row, columns.get(name)) for name in COLUMNS))
+        await limiter.acquire()
+        result = await client.calculate_customs(quote_params(fields))
+        if not result:
+            raise ValueError("Ошибка расчёта, попробуйте позже.")
+        commission = commissions[fields["region"]]
+        return [round(result["sbor"]), round(result["tax"]), round(result["util"]),
+                round(commission.cny_fee), round(commission.russia_fee),
+                round(result["total2"] + commission.total), commission.destination, ""]
+
+    with open(destination, 'w', newline='', encoding='utf-8-sig') as out:
+        writer = csv.writer(out)
+        writer.writerow(list(header) + list(RESULT_COLUMNS))
+
+        def emit(index: int, row: List):
+            # Строки готовы не по порядку: пишем, как только готов непрерывный префикс
+            nonlocal next_index
+            ready[index] = row
+            while next_index in ready:
+                writer.writerow(ready.pop(next_index))
+                next_index += 1
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                index, row = item
+                row = (list(row) + [""] * width)[:width]
+                try:
+                    values = await price_row(row)
+                    stats["priced"] += 1
+                except ValueError as e:
+                    values = [""] * (len(RESULT_COLUMNS) - 1) + [str(e)]
+                    stats["errors"] += 1
+                except Exception as e:
+                    logger.error("Ошибка пакетного расчёта строки %s: %s", index + 1, e)
+                    values = [""] * (len(RESULT_COLUMNS) - 1) + ["Внутренняя ошибка."]
+                    stats["errors"] += 1
+                emit(index, row + values)
+
+        async def report():
+            while True:
+                await asyncio.sleep(BULK_PROGRESS_INTERVAL)
+                try:
+                    await on_progress(stats)
+                except Exception as e:
+                    logger.warning("Ошибка отправки прогресса: %s", e)
+
+        tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+        reporter = asyncio.ensure_future(report()) if on_progress else None
+        try:
+            index = 0
+            while chunk:
+                for row in chunk:
+                    if index >= max_rows:
+                        stats["truncated"] = True
+                        break
+                    stats["rows"] += 1
+                    await queue.put((index, row))
+                    index += 1
+                if stats["truncated"]:
+                    break
+                # Следующая порция читается в потоке, пока воркеры считают очередь
+                chunk = await loop.run_in_executor(None, _take, rows, min(BULK_READ_CHUNK, max_rows - index + 1))
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if reporter is not None:
+                reporter.cancel()
+
+    stats["duration"] = time.perf_counter() - started
+    logger.info("Пакетный расчёт: %s", stats)
+    return stats
+
+
+async def _main(args):
+    from customs import create_customs_client
+    from startup import warmup
+
+    if not load_cached_rate():
+        try:
+            await update_exchange_rate()
+        except Exception as e:
+            logger.error("Не удалось обновить курсы, используются сохранённые: %s", e)
+
+    async def progress(stats: Dict):
+        print(f"Посчитано: {stats['priced']}, ошибок: {stats['errors']}", file=sys.stderr)
+
+    client = create_customs_client()
+    await warmup.wait_ready()
+    try:
+        return await price_file(args.input, args.output, client, workers=args.workers,
+                                limiter=TokenBucket(args.rate), max_rows=args.max_rows, on_progress=progress)
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетный расчёт растаможки по CSV/XLSX-файлу")
+    parser.add_argument("input", help="CSV или XLSX со столбцами region, age, engine, capacity, power, price")
+    parser.add_argument("-o", "--output", help="куда записать результат (по умолчанию <input>_quotes.csv)")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS)
+    parser.add_argument("--rate", type=float, default=BULK_RATE_LIMIT, help="запросов к API в секунду, 0 — без ограничения")
+    parser.add_argument("--max-rows", type=int, default=BULK_MAX_ROWS)
+    args = parser.parse_args()
+    args.output = args.output or os.path.splitext(args.input)[0] + "_quotes.csv"
+
+    try:
+        stats = asyncio.run(_main(args))
+    except ValueError as e:
+        sys.exit(str(e))
+    print(f"Готово: {stats['priced']} расчётов, ошибок: {stats['errors']}, "
+          f"{stats['duration']:.1f} с -> {args.output}")
+    if stats["truncated"]:
+        print(f"Обработаны только первые {args.max_rows} строк")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    from log_setup import setup_logging
+    setup_logging(fmt="text")
+    main()
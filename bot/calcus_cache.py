@@ -0,0 +1,270 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, List, Optional, Set, Tuple
+from api_client import params_key, _normalize
+from quote_log import mark_source
+from scheduler import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Параметры кэша по умолчанию (переопределяются переменными окружения)
+CACHE_MAX_SIZE = int(os.getenv("CALCUS_CACHE_SIZE", "5000"))
+CACHE_TTL = float(os.getenv("CALCUS_CACHE_TTL", "0"))  # 0 — до конца дня
+CACHE_DB_FILE = os.getenv("CALCUS_CACHE_DB", "")  # пусто — только в памяти
+# Шаги округления параметров (0 — без округления)
+PRICE_STEP = float(os.getenv("CALCUS_CACHE_PRICE_STEP", "0"))
+CAPACITY_STEP = float(os.getenv("CALCUS_CACHE_CAPACITY_STEP", "0"))
+POWER_STEP = float(os.getenv("CALCUS_CACHE_POWER_STEP", "0"))
+# Отвечать устаревшей записью, если calcus.ru недоступен
+SERVE_STALE = os.getenv("CALCUS_CACHE_SERVE_STALE", "1") != "0"
+
+
+def _round_to_step(value, step: float):
+    if not step or value is None:
+        return value
+    return _normalize(round(float(value) / step) * step)
+
+
+class CalcusCache:
+    """
+    LRU-кэш результатов calcus.ru с ограничением размера.
+
+    Записи действительны в пределах дня, за который посчитаны (calcus пересчитывает
+    валюты по курсу дня), и дополнительно могут ограничиваться TTL. При заданном
+    db_file записи дублируются в SQLite (после open()) и переживают перезапуск; промах в памяти
+    проверяется по базе, так что несколько процессов делят записи друг друга. Чтение
+    базы выполняется в потоке, запись — в потоке ввода-вывода планировщика, цикл событий
+    работает только с памятью.
+    Устаревшие записи остаются в памяти до вытеснения и отдаются через get_stale(),
+    когда calcus.ru недоступен.
+    """
+
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, ttl: float = CACHE_TTL,
+                 db_file: Optional[str] = CACHE_DB_FILE or None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_file = db_file
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        # Соединение используется из цикла (open, close) и из потоков чтения и записи
+        self._lock = threading.Lock()
+        self._writes: Set[asyncio.Future] = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+
+    def _connect(self) -> Tuple[sqlite3.Connection, List[Tuple[str, tuple]]]:
+        """Открывает базу, удаляет записи прошлых дней и читает последние записи за сегодня."""
+        conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS calcus_cache (
+                    key TEXT PRIMARY KEY,
+                    day TEXT,
+                    created REAL,
+                    result TEXT
+                )
+            """)
+            conn.execute("DELETE FROM calcus_cache WHERE day != ?", (str(date.today()),))
+            conn.commit()
+            rows = conn.execute(
+                "SELECT key, day, created, result FROM calcus_cache ORDER BY created DESC LIMIT ?",
+                (self.max_size,)
+            ).fetchall()
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn, [(key, (day, created, json.loads(result))) for key, day, created, result in reversed(rows)]
+
+    async def open(self):
+        """
+        Открывает базу и загружает записи за сегодня; до этого кэш работает только в памяти.
+        База читается в потоке ввода-вывода, записи добавляются в память в цикле.
+        """
+        if not self.db_file or self._conn is not None:
+            return
+        try:
+            self._conn, entries = await run_blocking(self._connect)
+        except sqlite3.Error as e:
+            logger.error("Ошибка при открытии кэша calcus: %s", e)
+            return
+        # Записи, появившиеся в памяти до открытия базы, остаются; из загруженных
+        # в оставшееся место попадают самые свежие
+        loaded = [(key, entry) for key, entry in entries if key not in self._entries]
+        room = self.max_size - len(self._entries)
+        for key, entry in (loaded[len(loaded) - room:] if room > 0 else []):
+            self._entries[key] = entry
+        logger.info("Загружено %s записей кэша calcus из %s", len(entries), self.db_file)
+
+    def _is_fresh(self, day: str, created: float) -> bool:
+        if day != str(date.today()):
+            return False
+        return not self.ttl or time.time() - created < self.ttl
+
+    def _store(self, key: str, entry: tuple) -> List[str]:
+        """Кладёт запись в память, вытесняя самые давние; возвращает вытесненные ключи."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        evicted = []
+        while len(self._entries) > self.max_size:
+            old_key, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            evicted.append(old_key)
+        return evicted
+
+    def _read_persisted(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            if self._conn is None:
+                return None
+            try:
+                row = self._conn.execute(
+                    "SELECT day, created, result FROM calcus_cache WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.error("Ошибка при чтении кэша calcus: %s", e)
+                return None
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def _write_persisted(self, upsert: Optional[tuple], deletes: List[str]):
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.executemany("DELETE FROM calcus_cache WHERE key = ?", [(key,) for key in deletes])
+                if upsert is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO calcus_cache (key, day, created, result) VALUES (?, ?, ?, ?)",
+                        upsert
+                    )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error("Ошибка при записи кэша calcus: %s", e)
+
+    def _persist(self, upsert: Optional[tuple], deletes: List[str]):
+        """Отправляет запись в базу в поток ввода-вывода, не дожидаясь её."""
+        if self._conn is None or (upsert is None and not deletes):
+            return
+        write = asyncio.ensure_future(run_blocking(self._write_persisted, upsert, deletes))
+        self._writes.add(write)
+        write.add_done_callback(self._writes.discard)
+
+    async def _lookup(self, key: str) -> Optional[tuple]:
+        entry = self._entries.get(key)
+        if entry is not None or self._conn is None:
+            return entry
+        entry = await asyncio.get_event_loop().run_in_executor(None, self._read_persisted, key)
+        if entry is None:
+            return None
+        # Пока шло чтение, запись могла появиться в памяти — она не старее прочитанной
+        if key in self._entries:
+            return self._entries[key]
+        self._persist(None, self._store(key, entry))
+        return entry
+
+    async def get(self, key: str) -> Optional[Dict]:
+        entry = await self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        day, created, result = entry
+        if not self._is_fresh(day, created):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    async def get_stale(self, key: str) -> Optional[Dict]:
+        """Запись независимо от свежести (None, если её нет)."""
+        entry = await self._lookup(key)
+        if entry is None:
+            return None
+        self.stale_hits += 1
+        return entry[2]
+
+    def set(self, key: str, result: Dict):
+        day, created = str(date.today()), time.time()
+        evicted = self._store(key, (day, created, result))
+        if self._conn is not None:
+            # Сериализуем в цикле: result — общий объект, который читают хендлеры
+            self._persist((key, day, created, json.dumps(result)), evicted)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_hits": self.stale_hits,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+    async def close(self):
+        """Дожидается отправленных записей и закрывает базу."""
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+
+class CachedCalcusClient:
+    """Обёртка над клиентом calcus.ru, отвечающая из кэша для повторяющихся параметров."""
+
+    def __init__(self, client, cache: Optional[CalcusCache] = None,
+                 price_step: float = PRICE_STEP, capacity_step: float = CAPACITY_STEP,
+                 power_step: float = POWER_STEP):
+        self.client = client
+        self.cache = cache or CalcusCache()
+        self.price_step = price_step
+        self.capacity_step = capacity_step
+        self.power_step = power_step
+
+    def _bucket(self, params: Dict) -> Dict:
+        """Округляет объём, мощность и цену до шага корзины (если шаги заданы)."""
+        bucketed = dict(params)
+        bucketed["engine_capacity"] = _round_to_step(params.get("engine_capacity"), self.capacity_step)
+        bucketed["engine_power"] = _round_to_step(params.get("engine_power"), self.power_step)
+        bucketed["vehicle_price"] = _round_to_step(params.get("vehicle_price"), self.price_step)
+        return bucketed
+
+    def cache_key(self, params: Dict) -> str:
+        return params_key(params)
+
+    async def calculate_customs(self, params: Dict, **kwargs) -> Optional[Dict]:
+        # В API уходят округлённые параметры, чтобы результат соответствовал ключу
+        params = self._bucket(params)
+        key = self.cache_key(params)
+        result = await self.cache.get(key)
+        if result is not None:
+            mark_source("cache")
+            return result
+        result = await self.client.calculate_customs(params, **kwargs)
+        if result:
+            self.cache.set(key, result)
+        elif SERVE_STALE:
+            result = await self.cache.get_stale(key)
+            if result is not None:
+                mark_source("stale")
+                logger.warning("calcus.ru недоступен, используется устаревший результат из кэша")
+        return result
+
+    def stats(self) -> Dict:
+        return self.cache.stats()
+
+    async def close(self):
+        await self.cache.close()
+        await self.client.close()
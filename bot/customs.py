@@ -0,0 +1,48 @@
+import os
+import convector
+import traffic_recorder
+from api_client import AsyncCalcusAPIClient
+from calcus_cache import CachedCalcusClient, CalcusCache
+from local_engine import LocalCustomsEngine, HybridCustomsClient
+from singleflight import CoalescingCalcusClient
+from resilience import ResilientCalcusClient
+from metrics import registry
+from startup import warmup
+
+
+def current_rates():
+    """Текущие курсы к рублю из актуального снимка хранилища курсов."""
+    return convector.rate_store.current().rates
+
+
+def create_customs_client():
+    """
+    Собирает клиент для расчёта таможенных платежей из слоёв:
+    локальный движок / calcus.ru (по CUSTOMS_ENGINE_MODE) -> кэш результатов ->
+    объединение одинаковых запросов -> повторы и предохранитель -> асинхронный клиент calcus.ru.
+
+    Кэш отключается переменной CALCUS_CACHE_ENABLED=0. CUSTOMS_ENGINE_MODE принимает
+    значения calcus (по умолчанию), local, fallback и shadow. Если задан QUOTE_GRID_SOURCE,
+    сверху добавляется сетка предрасчитанных результатов (нужен пакет numpy). При записи
+    трафика (TRAFFIC_RECORD_FILE) в неё попадают ответы calcus.ru.
+    """
+    recorder = traffic_recorder.recorder
+    resilient = ResilientCalcusClient(AsyncCalcusAPIClient(on_response=recorder and recorder.record_calcus))
+    registry.collector("calcus_resilience", resilient.stats)
+    client = CoalescingCalcusClient(resilient)
+    registry.collector("calcus_singleflight", client.stats)
+    if os.getenv("CALCUS_CACHE_ENABLED", "1") != "0":
+        cache = CalcusCache()
+        # Записи кэша с диска подгружаются в фоне после запуска
+        warmup.add("calcus_cache", cache.open)
+        client = CachedCalcusClient(client, cache)
+        registry.collector("calcus_cache", client.stats)
+    mode = os.getenv("CUSTOMS_ENGINE_MODE", "calcus")
+    if mode != "calcus":
+        client = HybridCustomsClient(client, LocalCustomsEngine(rate_provider=current_rates), mode)
+    if os.getenv("QUOTE_GRID_SOURCE"):
+        from quote_grid import GridCustomsClient
+        # Сетка из calcus строится в обход кэша и объединения запросов
+        client = GridCustomsClient(client, remote_client=resilient)
+        registry.collector("quote_grid", client.stats)
+    return client
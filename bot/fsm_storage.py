@@ -0,0 +1,263 @@
+import copy
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from aiogram.dispatcher.storage import BaseStorage
+from batch_writer import SQLiteBatchWriter
+
+logger = logging.getLogger(__name__)
+
+# Тип хранилища: sqlite (по умолчанию), memory или redis
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+# Через сколько секунд бездействия незавершённый диалог удаляется
+FSM_TTL = float(os.getenv("FSM_TTL", "3600"))
+# Путь к базе SQLite для состояний
+FSM_DB_FILE = os.getenv("FSM_DB_FILE", "fsm_state.db")
+# Как часто изменённые состояния записываются на диск, секунды
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "2"))
+# Как часто удаляются просроченные состояния, секунды
+FSM_EVICT_INTERVAL = float(os.getenv("FSM_EVICT_INTERVAL", "60"))
+# На сколько секунд время последнего обращения (только чтение) может отставать в базе
+FSM_TOUCH_INTERVAL = float(os.getenv("FSM_TOUCH_INTERVAL", "60"))
+
+Key = Tuple[int, int]
+
+
+class _Record:
+    """Состояние одного пользователя в одном чате."""
+    __slots__ = ("state", "data", "bucket", "touched", "saved")
+
+    def __init__(self, state=None, data=None, bucket=None, touched: float = 0.0):
+        self.state = state
+        self.data = data or {}
+        self.bucket = bucket or {}
+        self.touched = touched
+        # touched, последний раз переданный на запись в базу
+        self.saved = touched
+
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data and not self.bucket
+
+
+class TTLStorage(SQLiteBatchWriter, BaseStorage):
+    """
+    Хранилище состояний FSM в памяти с вытеснением по времени бездействия.
+
+    Записи, к которым не обращались дольше ttl секунд, удаляются evict_expired().
+    При заданном db_file изменения пачками записываются в SQLite (см. SQLiteBatchWriter),
+    а при старте open() загружает все непросроченные записи обратно, поэтому незавершённые
+    расчёты переживают перезапуск. Если задан shard (номер, всего), загружаются
+    и вытесняются только записи пользователей с user % всего == номер, что
+    позволяет нескольким процессам делить один файл.
+    """
+
+    flush_operation = "fsm_flush"
+
+    def __init__(self, ttl: float = FSM_TTL, db_file: Optional[str] = None,
+                 shard: Optional[Tuple[int, int]] = None):
+        super().__init__()
+        self.ttl = ttl
+        self.db_file = db_file
+        self.shard = shard
+        self._records: Dict[Key, _Record] = {}
+        self._dirty: Set[Key] = set()
+        self.evictions = 0
+        self.flushes = 0
+
+    def open(self):
+        """Открывает базу и восстанавливает состояния; записи, изменённые до этого в памяти, новее и остаются."""
+        if not self.db_file or self._conn is not None:
+            return
+        self._conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                chat INTEGER,
+                user INTEGER,
+                state TEXT,
+                data TEXT,
+                bucket TEXT,
+                touched REAL,
+                PRIMARY KEY (chat, user)
+            )
+        """)
+        index, count = self.shard or (0, 1)
+        self._conn.execute("DELETE FROM fsm WHERE touched < ? AND user % ? = ?",
+                           (time.time() - self.ttl, count, index))
+        self._conn.commit()
+        for chat, user, state, data, bucket, touched in self._conn.execute(
+                "SELECT chat, user, state, data, bucket, touched FROM fsm WHERE user % ? = ?", (count, index)):
+            self._records.setdefault((chat, user), _Record(state, json.loads(data), json.loads(bucket), touched))
+        logger.info("Восстановлено состояний FSM: %s", len(self._records))
+
+    def _key(self, chat, user) -> Key:
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    def _get(self, chat, user) -> Optional[_Record]:
+        key = self._key(chat, user)
+        record = self._records.get(key)
+        if record is not None:
+            record.touched = time.time()
+            # Иначе после перезапуска open() удалил бы диалог, который пользователь только читал
+            if record.touched - record.saved >= FSM_TOUCH_INTERVAL:
+                self._dirty.add(key)
+        return record
+
+    def _get_or_create(self, chat, user) -> Tuple[Key, _Record]:
+        key = self._key(chat, user)
+        record = self._records.get(key)
+        if record is None:
+            record = self._records[key] = _Record()
+        record.touched = time.time()
+        self._dirty.add(key)
+        return key, record
+
+    def _compact(self, key: Key, record: _Record):
+        if record.is_empty():
+            self._records.pop(key, None)
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        record = self._get(chat, user)
+        if record is None or record.state is None:
+            return self.resolve_state(default)
+        return record.state
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> Dict:
+        record = self._get(chat, user)
+        if record is None:
+            return copy.deepcopy(default) if default else {}
+        return copy.deepcopy(record.data)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = self._get_or_create(chat, user)
+        record.state = self.resolve_state(state)
+        self._compact(key, record)
+
+    async def set_data(self, *, chat=None, user=None, data: Dict = None):
+        key, record = self._get_or_create(chat, user)
+        record.data = copy.deepcopy(data) if data else {}
+        self._compact(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data: Dict = None, **kwargs):
+        key, record = self._get_or_create(chat, user)
+        record.data.update(data or {}, **kwargs)
+        self._compact(key, record)
+
+    async def reset_state(self, *, chat=None, user=None, with_data: Optional[bool] = True):
+        key, record = self._get_or_create(chat, user)
+        record.state = None
+        if with_data:
+            record.data = {}
+        self._compact(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default: Optional[dict] = None) -> Dict:
+        record = self._get(chat, user)
+        if record is None:
+            return copy.deepcopy(default) if default else {}
+        return copy.deepcopy(record.bucket)
+
+    async def set_bucket(self, *, chat=None, user=None, bucket: Dict = None):
+        key, record = self._get_or_create(chat, user)
+        record.bucket = copy.deepcopy(bucket) if bucket else {}
+        self._compact(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket: Dict = None, **kwargs):
+        key, record = self._get_or_create(chat, user)
+        record.bucket.update(bucket or {}, **kwargs)
+        self._compact(key, record)
+
+    def evict_expired(self) -> int:
+        """Удаляет состояния пользователей, бездействующих дольше ttl."""
+        deadline = time.time() - self.ttl
+        expired = [key for key, record in self._records.items() if record.touched < deadline]
+        for key in expired:
+            del self._records[key]
+            self._dirty.add(key)
+        self.evictions += len(expired)
+        if expired:
+            logger.info("Удалено просроченных состояний FSM: %s", len(expired))
+        return len(expired)
+
+    def _pending(self) -> bool:
+        return bool(self._dirty) and self._conn is not None
+
+    def _take(self) -> Tuple[Set[Key], List[tuple], List[Key]]:
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for key in keys:
+            record = self._records.get(key)
+            if record is None:
+                deletes.append(key)
+            else:
+                upserts.append((key[0], key[1], record.state, json.dumps(record.data, ensure_ascii=False),
+                                json.dumps(record.bucket, ensure_ascii=False), record.touched))
+                record.saved = record.touched
+        return keys, upserts, deletes
+
+    def _write(self, batch: Tuple[Set[Key], List[tuple], List[Key]]):
+        _, upserts, deletes = batch
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?, ?, ?)", upserts)
+            conn.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", deletes)
+
+    def _write_failed(self, batch: Tuple[Set[Key], List[tuple], List[Key]], error: sqlite3.Error):
+        logger.error("Ошибка при сохранении состояний FSM: %s", error)
+        self._dirty.update(batch[0])
+
+    def _written(self, batch: Tuple[Set[Key], List[tuple], List[Key]]):
+        self.flushes += 1
+
+    def stats(self) -> Dict:
+        """Число записей и приблизительный объём занимаемой ими памяти в байтах."""
+        size = sys.getsizeof(self._records)
+        for record in self._records.values():
+            size += sys.getsizeof(record) + sys.getsizeof(record.data) + sys.getsizeof(record.bucket)
+            size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in record.data.items())
+        return {
+            "records": len(self._records),
+            "bytes": size,
+            "dirty": len(self._dirty),
+            "evictions": self.evictions,
+            "flushes": self.flushes
+        }
+
+    async def close(self):
+        self._close_connection()
+
+    async def wait_closed(self):
+        pass
+
+
+def create_storage(shard: Optional[Tuple[int, int]] = None) -> BaseStorage:
+    """
+    Создаёт хранилище состояний по FSM_STORAGE.
+
+    redis использует RedisStorage2 из aiogram (нужен пакет aioredis, адрес из REDIS_HOST/REDIS_PORT)
+    с тем же TTL; memory хранит состояния только в памяти процесса.
+    """
+    if FSM_STORAGE == "redis":
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+        ttl = int(FSM_TTL)
+        return RedisStorage2(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379")),
+                             state_ttl=ttl, data_ttl=ttl, bucket_ttl=ttl)
+    if FSM_STORAGE == "memory":
+        return TTLStorage(shard=shard)
+    return TTLStorage(db_file=FSM_DB_FILE, shard=shard)
+
+
+def schedule_storage_tasks(scheduler, storage: BaseStorage):
+    """Планирует вытеснение просроченных состояний и запись изменений на диск."""
+    if not isinstance(storage, TTLStorage):
+        return
+    scheduler.every(FSM_EVICT_INTERVAL, "evict_fsm_states", storage.evict_expired)
+    if storage.db_file:
+        scheduler.every(FSM_FLUSH_INTERVAL, "flush_fsm_states", storage.flush_in_background)
@@ -1,29 +1,161 @@
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
-from aiogram.dispatcher.filters import Text, RegexpCommandsFilter
-from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from api_client import CalcusAPIClient
-from keyboards import get_region_keyboard, get_age_keyboard, get_engine_type_keyboard
-from convector import USD_TO_RUB, CNY_TO_RUB
+from aiogram.dispatcher.filters import Text
+from customs import create_customs_client
+from keyboards import REGION_KEYBOARD, AGE_KEYBOARD, ENGINE_TYPE_KEYBOARD, REMOVE_KEYBOARD
+from states import CalculationStates
+from convector import rate_store
 from usage_tracker import check_and_update_usage, MAX_ATTEMPTS
+from metrics import format_stats
+from sender import outbox, HIGH, LOW
+from pricing import REGIONS, AGES, ENGINE_TYPES, ENGINES_WITHOUT_CAPACITY, region_commission
+from quote_log import quote_log, calculate_and_log, format_report
+from bulk_quote import price_file, BULK_EXTENSIONS, BULK_MAX_FILE_SIZE, BULK_MAX_ROWS
+from quick_quote import parse_quick_quote, QUICK_QUOTE_PATTERN, USAGE as QUICK_QUOTE_USAGE
 import logging
-import re
+import os
+import tempfile
 
-logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 logger = logging.getLogger(__name__)
 
-# Определение состояний FSM
-class CalculationStates(StatesGroup):
-    region = State()
-    age = State()
-    engine_type = State()
-    engine_capacity = State()
-    engine_power = State()
-    price = State()
+# Пользователи, которым доступна команда /stats (id через запятую)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+# Партнёры, которым доступен пакетный расчёт по файлу (и администраторы)
+BULK_USER_IDS = ADMIN_IDS | {int(user_id) for user_id in os.getenv("BULK_USER_IDS", "").split(",") if user_id.strip()}
+
+
+def _quote_template(region: str) -> str:
+    """Шаблон ответа с расчётом для региона; постоянные части подставлены заранее."""
+    lines = [
+        "Результаты расчёта:",
+        "Таможенный сбор: {sbor:,.0f} RUB",
+        "Таможенная пошлина: {tax:,.0f} RUB",
+        "Утилизационный сбор: {util:,.0f} RUB",
+    ]
+    if REGIONS[region].cny:
+        lines.append(f"Комиссия ({region}, CNY): {{cny_fee:,.0f}} RUB")
+    lines += [
+        "Комиссия (Росси, RUB): {russia_fee:,.0f} RUB",
+        f"Итоговая стоимость до {REGIONS[region].destination}: {{total:,.0f}} RUB",
+        "",
+        "Осталось расчётов на сегодня: {remaining_attempts}",
+        "Чтобы ещё раз рассчитать, напишите /start",
+    ]
+    return "\n".join(lines)
+
+
+# Шаблоны ответа по регионам строятся один раз при импорте
+QUOTE_TEMPLATES = {region: _quote_template(region) for region in REGIONS}
+# Запрос цены после мощности — в валюте региона
+PRICE_PROMPTS = {region: f"Введите стоимость автомобиля ({info.currency}):" for region, info in REGIONS.items()}
+
+
+def format_quote(region: str, result: dict, remaining_attempts: int) -> str:
+    """Считает комиссии и итоговую стоимость и формирует ответ пользователю."""
+    # Комиссии (по одному снимку курсов на весь расчёт)
+    commission = region_commission(region, rate_store.current())
+    return QUOTE_TEMPLATES[region].format(
+        sbor=result["sbor"], tax=result["tax"], util=result["util"],
+        cny_fee=commission.cny_fee, russia_fee=commission.russia_fee,
+        total=result["total2"] + commission.total, remaining_attempts=remaining_attempts,
+    )
+
 
 def register_handlers(dp: Dispatcher):
-    client = CalcusAPIClient()
+    client = create_customs_client()
+    # Клиент хранится в диспетчере, чтобы закрыть пул соединений при остановке
+    dp['calcus_client'] = client
+
+    @dp.message_handler(lambda message: message.from_user.id in ADMIN_IDS, commands=['stats'], state='*')
+    async def cmd_stats(message: types.Message):
+        outbox.answer(message, format_stats())
+
+    @dp.message_handler(lambda message: message.from_user.id in ADMIN_IDS, commands=['quotes'], state='*')
+    async def cmd_quotes(message: types.Message):
+        # /quotes [дней] — популярные конфигурации и задержка calcus.ru по дням
+        args = message.get_args()
+        days = int(args) if args.isdigit() and int(args) > 0 else 7
+        try:
+            report = await quote_log.report(days)
+        except Exception as e:
+            logger.error("Ошибка отчёта по журналу расчётов: %s", e)
+            outbox.answer(message, "Журнал расчётов недоступен.")
+            return
+        outbox.answer(message, format_report(report))
+
+    @dp.message_handler(lambda message: message.from_user.id in BULK_USER_IDS,
+                        content_types=[types.ContentType.DOCUMENT], state='*')
+    async def process_bulk_file(message: types.Message):
+        document = message.document
+        name, extension = os.path.splitext(document.file_name or "")
+        if extension.lower() not in BULK_EXTENSIONS:
+            outbox.answer(message, "Для пакетного расчёта пришлите файл CSV или XLSX со столбцами "
+                                   "region, age, engine, capacity, power, price.")
+            return
+        if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+            outbox.answer(message, f"Файл слишком большой (не больше {BULK_MAX_FILE_SIZE // 1024 // 1024} МБ).")
+            return
+
+        status = await outbox.answer(message, "Файл получен, начинаю расчёт…", HIGH)
+        last_progress = status.text
+
+        async def report(stats: dict):
+            nonlocal last_progress
+            text = f"Посчитано: {stats['priced']}, ошибок: {stats['errors']}…"
+            if text != last_progress:
+                last_progress = text
+                outbox.submit(status.chat.id, "edit_message_text", LOW, message_id=status.message_id, text=text)
+
+        with tempfile.TemporaryDirectory(prefix="bulk-") as directory:
+            source = os.path.join(directory, "input" + extension.lower())
+            await document.download(destination_file=source)
+            destination = os.path.join(directory, "quotes.csv")
+            try:
+                stats = await price_file(source, destination, client, on_progress=report)
+            except ValueError as e:
+                outbox.answer(message, str(e))
+                return
+            caption = f"Готово: {stats['priced']} расчётов, ошибок: {stats['errors']}."
+            if stats["truncated"]:
+                caption += f" Посчитаны только первые {BULK_MAX_ROWS} строк."
+            # Ждём отправки: файл удаляется вместе с временным каталогом
+            await outbox.submit(message.chat.id, "send_document", LOW,
+                                document=types.InputFile(destination, filename=f"{name}_quotes.csv"), caption=caption)
+
+    async def answer_quick_quote(message: types.Message, text: str):
+        """Расчёт по одному сообщению: те же проверки, лимит и формат ответа, что у диалога."""
+        try:
+            data = parse_quick_quote(text)
+        except ValueError as e:
+            outbox.answer(message, str(e))
+            return
+
+        can_proceed, remaining_attempts, reset_date = check_and_update_usage(message.from_user.id)
+        if not can_proceed:
+            outbox.answer(message,
+                f"Вы исчерпали лимит ({MAX_ATTEMPTS} расчёта в день). "
+                f"Попробуйте снова завтра ({reset_date})."
+            )
+            return
+
+        result = await calculate_and_log(client, data, message.from_user.id, "quick")
+        if not result:
+            outbox.answer(message, "Ошибка расчёта. Попробуйте позже.")
+            return
+        outbox.answer(message, format_quote(data["region"], result, remaining_attempts),
+                      reply_markup=REMOVE_KEYBOARD)
+
+    @dp.message_handler(commands=['calc'], state='*')
+    async def cmd_calc(message: types.Message):
+        text = message.get_args()
+        if not text:
+            outbox.answer(message, QUICK_QUOTE_USAGE)
+            return
+        await answer_quick_quote(message, text)
+
+    @dp.message_handler(regexp=QUICK_QUOTE_PATTERN)
+    async def process_quick_quote(message: types.Message):
+        await answer_quick_quote(message, message.text)
 
     @dp.message_handler(commands=['start'])
     async def cmd_start(message: types.Message, state: FSMContext):
@@ -31,7 +163,7 @@ def register_handlers(dp: Dispatcher):
         can_proceed, remaining_attempts, reset_date = check_and_update_usage(user_id)
 
         if not can_proceed:
-            await message.answer(
+            outbox.answer(message,
                 f"Вы исчерпали лимит ({MAX_ATTEMPTS} расчёта в день). "
                 f"Попробуйте снова завтра ({reset_date})."
             )
@@ -42,45 +174,38 @@ def register_handlers(dp: Dispatcher):
         async with state.proxy() as data:
             data['remaining_attempts'] = remaining_attempts
 
-        await message.answer("Выберите регион:", reply_markup=get_region_keyboard())
+        outbox.answer(message, "Выберите регион:", reply_markup=REGION_KEYBOARD)
         await CalculationStates.region.set()
 
-    @dp.message_handler(Text(equals=["Китай", "Корея"]), state=CalculationStates.region)
+    @dp.message_handler(Text(equals=list(REGIONS)), state=CalculationStates.region)
     async def process_region(message: types.Message, state: FSMContext):
         async with state.proxy() as data:
             data['region'] = message.text
-        await message.answer("Выберите возраст автомобиля:", reply_markup=get_age_keyboard())
+        outbox.answer(message, "Выберите возраст автомобиля:", reply_markup=AGE_KEYBOARD)
         await CalculationStates.age.set()
 
-    @dp.message_handler(Text(equals=["до 3", "3-5"]), state=CalculationStates.age)
+    @dp.message_handler(Text(equals=list(AGES)), state=CalculationStates.age)
     async def process_age(message: types.Message, state: FSMContext):
         async with state.proxy() as data:
             data['vehicle_age'] = message.text
-        await message.answer("Выберите тип двигателя:", reply_markup=get_engine_type_keyboard())
+        outbox.answer(message, "Выберите тип двигателя:", reply_markup=ENGINE_TYPE_KEYBOARD)
         await CalculationStates.engine_type.set()
 
-    @dp.message_handler(Text(equals=["Бензиновый", "Дизельный", "Гибридный", "Электрический"]),
-                        state=CalculationStates.engine_type)
+    @dp.message_handler(Text(equals=list(ENGINE_TYPES)), state=CalculationStates.engine_type)
     async def process_engine_type(message: types.Message, state: FSMContext):
-        engine_map = {
-            "Бензиновый": "gasoline",
-            "Дизельный": "diesel",
-            "Гибридный": "hybrid",
-            "Электрический": "electric"
-        }
         try:
             async with state.proxy() as data:
-                data['engine_type'] = engine_map[message.text]
-                if data['engine_type'] == "electric":
+                data['engine_type'] = ENGINE_TYPES[message.text]
+                if data['engine_type'] in ENGINES_WITHOUT_CAPACITY:
                     data['engine_capacity'] = 0  # Устанавливаем объём 0 для электрического
-                    await message.answer("Введите мощность двигателя (л.с.):", reply_markup=types.ReplyKeyboardRemove())
+                    outbox.answer(message, "Введите мощность двигателя (л.с.):", reply_markup=REMOVE_KEYBOARD)
                     await CalculationStates.engine_power.set()
                 else:
-                    await message.answer("Введите объём двигателя (см³):", reply_markup=types.ReplyKeyboardRemove())
+                    outbox.answer(message, "Введите объём двигателя (см³):", reply_markup=REMOVE_KEYBOARD)
                     await CalculationStates.engine_capacity.set()
         except LookupError as e:
-            logger.error(f"Ошибка состояния: {e}")
-            await message.answer("Произошла ошибка. Пожалуйста, начните заново с /start.")
+            logger.error("Ошибка состояния: %s", e)
+            outbox.answer(message, "Произошла ошибка. Пожалуйста, начните заново с /start.")
             await state.finish()
 
     @dp.message_handler(regexp=r'^\d+(\.\d+)?$', state=CalculationStates.engine_capacity)
@@ -91,13 +216,13 @@ def register_handlers(dp: Dispatcher):
                 raise ValueError("Объём должен быть положительным")
             async with state.proxy() as data:
                 data['engine_capacity'] = capacity
-            await message.answer("Введите мощность двигателя (л.с.):")
+            outbox.answer(message, "Введите мощность двигателя (л.с.):")
             await CalculationStates.engine_power.set()
         except ValueError:
-            await message.answer("Пожалуйста, введите корректное число (например, 2000).")
+            outbox.answer(message, "Пожалуйста, введите корректное число (например, 2000).")
         except LookupError as e:
-            logger.error(f"Ошибка состояния: {e}")
-            await message.answer("Произошла ошибка. Пожалуйста, начните заново с /start.")
+            logger.error("Ошибка состояния: %s", e)
+            outbox.answer(message, "Произошла ошибка. Пожалуйста, начните заново с /start.")
             await state.finish()
 
     @dp.message_handler(regexp=r'^\d+(\.\d+)?$', state=CalculationStates.engine_power)
@@ -108,14 +233,14 @@ def register_handlers(dp: Dispatcher):
                 raise ValueError("Мощность должна быть положительной")
             async with state.proxy() as data:
                 data['engine_power'] = power
-                currency = "CNY" if data["region"] == "Китай" else "KRW"
-            await message.answer(f"Введите стоимость автомобиля ({currency}):")
+                prompt = PRICE_PROMPTS[data["region"]]
+            outbox.answer(message, prompt)
             await CalculationStates.price.set()
         except ValueError:
-            await message.answer("Пожалуйста, введите корректное число (например, 300).")
+            outbox.answer(message, "Пожалуйста, введите корректное число (например, 300).")
         except LookupError as e:
-            logger.error(f"Ошибка состояния: {e}")
-            await message.answer("Произошла ошибка. Пожалуйста, начните заново с /start.")
+            logger.error("Ошибка состояния: %s", e)
+            outbox.answer(message, "Произошла ошибка. Пожалуйста, начните заново с /start.")
             await state.finish()
 
     @dp.message_handler(regexp=r'^\d+(\.\d+)?$', state=CalculationStates.price)
@@ -125,63 +250,23 @@ def register_handlers(dp: Dispatcher):
             if price <= 0:
                 raise ValueError("Стоимость должна быть положительной")
             async with state.proxy() as data:
-                currency = "CNY" if data["region"] == "Китай" else "KRW"
                 data['vehicle_price'] = price
-                data['currency'] = currency
                 remaining_attempts = data['remaining_attempts']
 
-            # Параметры для API
-            params = {
-                "vehicle_age": data["vehicle_age"],
-                "engine_type": data["engine_type"],
-                "engine_power": data["engine_power"],
-                "engine_capacity": data["engine_capacity"],
-                "vehicle_price": data["vehicle_price"],
-                "currency": data["currency"]
-            }
-
             # Вызов API
-            result = client.calculate_customs(params)
+            result = await calculate_and_log(client, data, message.from_user.id, "dialog")
             if not result:
-                await message.answer("Ошибка расчёта. Попробуйте позже.")
+                outbox.answer(message, "Ошибка расчёта. Попробуйте позже.")
                 await state.finish()
                 return
 
-            # Комиссии
-            region = data["region"]
-            if region == "Китай":
-                cny_fee = 16000 * CNY_TO_RUB
-                usd_fee = 3900 * USD_TO_RUB
-                rub_fee = 50000
-                destination = "Перми"
-            else:
-                usd_fee = 2500 * USD_TO_RUB
-                rub_fee = 150000
-                cny_fee = 0
-                destination = "Владивостока"
-
-            # Итоговая стоимость
-            total_cost = result["total2"] + usd_fee + rub_fee + cny_fee
-
-            # Формирование ответа
-            response = (
-                f"Результаты расчёта:\n"
-                f"Таможенный сбор: {result['sbor']:,.0f} RUB\n"
-                f"Таможенная пошлина: {result['tax']:,.0f} RUB\n"
-                f"Утилизационный сбор: {result['util']:,.0f} RUB\n"
-                + (f"Комиссия (Китай, CNY): {cny_fee:,.0f} RUB\n" if region == "Китай" else "")
-                + f"Комиссия (Росси, RUB): {rub_fee + usd_fee:,.0f} RUB\n"
-                + f"Итоговая стоимость до {destination}: {total_cost:,.0f} RUB\n\n"
-                f"Осталось расчётов на сегодня: {remaining_attempts}\n"
-                f"Чтобы ещё раз рассчитать, напишите /start"
-            )
-
-            await message.answer(response, reply_markup=types.ReplyKeyboardRemove())
+            response = format_quote(data["region"], result, remaining_attempts)
+            outbox.answer(message, response, reply_markup=REMOVE_KEYBOARD)
             await state.finish()
 
         except ValueError:
-            await message.answer("Пожалуйста, введите корректное число (например, 5000000).")
+            outbox.answer(message, "Пожалуйста, введите корректное число (например, 5000000).")
         except LookupError as e:
-            logger.error(f"Ошибка состояния: {e}")
-            await message.answer("Произошла ошибка. Пожалуйста, начните заново с /start.")
+            logger.error("Ошибка состояния: %s", e)
+            outbox.answer(message, "Произошла ошибка. Пожалуйста, начните заново с /start.")
             await state.finish()
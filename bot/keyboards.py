@@ -1,21 +1,24 @@
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from typing import Iterable
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from pricing import REGIONS, AGES, ENGINE_TYPES
 
-def get_region_keyboard():
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(KeyboardButton("Китай"))
-    keyboard.add(KeyboardButton("Корея"))
-    return keyboard
 
-def get_age_keyboard():
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(KeyboardButton("до 3"))
-    keyboard.add(KeyboardButton("3-5"))
-    return keyboard
+def _serialize(markup) -> str:
+    # Готовая строка JSON передаётся в reply_markup как есть: aiogram не сериализует
+    # её заново, а общая неизменяемая строка не может быть испорчена обработчиком
+    return markup.as_json()
+
 
-def get_engine_type_keyboard():
+def build_keyboard(labels: Iterable[str]) -> str:
+    """Клавиатура с кнопкой на каждую строку labels, уже сериализованная для API."""
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(KeyboardButton("Бензиновый"))
-    keyboard.add(KeyboardButton("Дизельный"))
-    keyboard.add(KeyboardButton("Гибридный"))
-    keyboard.add(KeyboardButton("Электрический"))
-    return keyboard
\ No newline at end of file
+    for label in labels:
+        keyboard.add(KeyboardButton(label))
+    return _serialize(keyboard)
+
+
+# Клавиатуры диалога строятся один раз при импорте по таблицам из pricing
+REGION_KEYBOARD = build_keyboard(REGIONS)
+AGE_KEYBOARD = build_keyboard(AGES)
+ENGINE_TYPE_KEYBOARD = build_keyboard(ENGINE_TYPES)
+REMOVE_KEYBOARD = _serialize(ReplyKeyboardRemove())
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+from datetime import date
+from typing import Callable, Dict, List, Optional
+from api_client import map_params
+from quote_log import mark_source
+
+logger = logging.getLogger(__name__)
+
+# Файл с версиями тарифов (по умолчанию лежит рядом с модулем)
+TARIFFS_FILE = os.getenv("TARIFFS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tariffs.json"))
+# Допустимое относительное расхождение с calcus в теневом режиме
+SHADOW_TOLERANCE = float(os.getenv("CUSTOMS_SHADOW_TOLERANCE", "0.01"))
+
+ENGINE_MODES = ("calcus", "local", "fallback", "shadow")
+RESULT_FIELDS = ("sbor", "tax", "util", "total2")
+
+
+def load_tariffs(path: str = TARIFFS_FILE, on_date: Optional[date] = None) -> Dict:
+    """
+    Загружает таблицу тарифов, действующую на указанную дату.
+
+    Args:
+        path: Путь к JSON-файлу с версиями тарифов.
+        on_date: Дата расчёта (по умолчанию сегодня).
+
+    Returns:
+        Словарь тарифов самой свежей версии с effective_from не позже on_date.
+    """
+    on_date = on_date or date.today()
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    versions = sorted(data["tariffs"], key=lambda t: t["effective_from"])
+    applicable = [t for t in versions if t["effective_from"] <= str(on_date)]
+    tariffs = applicable[-1] if applicable else versions[0]
+    logger.info("Загружены тарифы версии %s", tariffs['version'])
+    return tariffs
+
+
+def _bracket(brackets: List, value: float) -> List:
+    """Возвращает строку таблицы, в границу которой попадает значение (null — без верхней границы)."""
+    for row in brackets:
+        if row[0] is None or value <= row[0]:
+            return row
+    return brackets[-1]
+
+
+class LocalCustomsEngine:
+    """
+    Локальный расчёт таможенных платежей по таблицам тарифов.
+
+    Возвращает те же поля, что и calcus.ru (sbor, tax, util, total2), без сетевых
+    запросов. Курсы валют берутся из rate_provider, недостающие — из fallback_rates
+    таблицы тарифов.
+    """
+
+    def __init__(self, tariffs: Optional[Dict] = None,
+                 rate_provider: Optional[Callable[[], Dict[str, float]]] = None):
+        self.tariffs = tariffs or load_tariffs()
+        self.rate_provider = rate_provider
+
+    def _rates(self) -> Dict[str, float]:
+        rates = dict(self.tariffs["fallback_rates"])
+        if self.rate_provider is not None:
+            rates.update({k: v for k, v in self.rate_provider().items() if v})
+        return rates
+
+    def calculate(self, params: Dict) -> Dict:
+        """
+        Рассчитывает платежи для параметров в формате бота.
+
+        Raises:
+            KeyError: Если возраст, тип двигателя или валюта не поддерживаются тарифами.
+        """
+        api_params = map_params(params)
+        rates = self._rates()
+        age = api_params["age"]
+        capacity = float(api_params["value"] or 0)
+        power = float(api_params["power"] or 0)
+        price_rub = float(api_params["price"]) * rates[api_params["curr"]]
+        eur = rates["EUR"]
+
+        sbor = _bracket(self.tariffs["clearance_fee"], price_rub)[1]
+
+        if api_params["engine"] == 4:
+            electric = self.tariffs["electric"]
+            duty = price_rub * electric["duty_rate"]
+            excise = power * _bracket(electric["excise_per_hp"], power)[1]
+            vat = (price_rub + duty + excise) * electric["vat_rate"]
+            tax = duty + excise + vat
+        elif age == "0-3":
+            _, rate, min_per_cm3 = _bracket(self.tariffs["duty"]["0-3"], price_rub / eur)
+            tax = max(price_rub * rate, capacity * min_per_cm3 * eur)
+        else:
+            tax = capacity * _bracket(self.tariffs["duty"][age], capacity)[1] * eur
+
+        util_rules = self.tariffs["util"]
+        if capacity <= util_rules["personal_max_capacity"]:
+            util_coefficient = util_rules["personal"][age]
+        else:
+            util_coefficient = _bracket(util_rules["commercial"][age], capacity)[1]
+        util = util_rules["base"] * util_coefficient
+
+        total = sbor + tax + util
+        return {
+            "sbor": round(sbor, 2),
+            "tax": round(tax, 2),
+            "util": round(util, 2),
+            "total": round(total, 2),
+            "total2": round(total + price_rub, 2)
+        }
+
+    async def calculate_customs(self, params: Dict, **kwargs) -> Optional[Dict]:
+        try:
+            return self.calculate(params)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Ошибка локального расчёта: %s", e)
+            return None
+
+    async def close(self):
+        pass
+
+
+class HybridCustomsClient:
+    """
+    Комбинирует calcus.ru и локальный расчёт.
+
+    Режимы:
+        local    — только локальный расчёт;
+        fallback — calcus.ru, при ошибке локальный расчёт;
+        shadow   — ответ calcus.ru, локальный расчёт сравнивается с ним и расхождения логируются.
+    """
+
+    def __init__(self, remote, local: LocalCustomsEngine, mode: str = "fallback"):
+        if mode not in ENGINE_MODES:
+            raise ValueError(f"Неизвестный режим расчёта: {mode}")
+        self.remote = remote
+        self.local = local
+        self.mode = mode
+
+    async def calculate_customs(self, params: Dict, **kwargs) -> Optional[Dict]:
+        if self.mode == "local":
+            mark_source("local")
+            return await self.local.calculate_customs(params)
+
+        result = await self.remote.calculate_customs(params, **kwargs)
+        if self.mode == "fallback" and not result:
+            logger.warning("calcus.ru недоступен, используется локальный расчёт")
+            mark_source("local")
+            return await self.local.calculate_customs(params)
+        if self.mode == "shadow" and result:
+            self._compare(params, result, await self.local.calculate_customs(params))
+        return result
+
+    def _compare(self, params: Dict, remote: Dict, local: Optional[Dict]):
+        if local is None:
+            return
+        diffs = {}
+        for field in RESULT_FIELDS:
+            expected, actual = remote.get(field), local.get(field)
+            if expected is None:
+                continue
+            if abs(actual - expected) > abs(expected) * SHADOW_TOLERANCE:
+                diffs[field] = (expected, actual)
+        if diffs:
+            logger.warning("Расхождение локального расчёта с calcus для %s: %s", map_params(params), diffs)
+
+    async def close(self):
+        await self.remote.close()
+        await self.local.close()
@@ -0,0 +1,190 @@
+"""
+Настройка логирования процесса.
+
+Модули только получают logger = logging.getLogger(__name__) и пишут сообщения в
+%-стиле с аргументами; настраивает вывод один раз точка входа через setup_logging().
+
+Запись из цикла событий лишь подставляет аргументы в сообщение и кладёт LogRecord
+в очередь: оформление строки и вывод выполняет отдельный поток. Записи выводятся строками JSON (LOG_FORMAT=json) или
+текстом. Каждое обновление Telegram получает идентификатор корреляции cid и
+пользователя, которые добавляются ко всем записям, сделанным при его обработке,
+в том числе к вызовам внешних API. Частые события (поле event в extra или имя
+логгера) прореживаются по LOG_SAMPLING; решение принимается по пользователю, так
+что для попавшего в выборку пользователя видны все его шаги и запросы к API.
+Предупреждения и ошибки не прореживаются.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Уровень логирования
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Формат вывода: json или text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Доля сохраняемых записей частых событий: событие=доля через запятую
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "update=0.1,upstream_call=0.1,aiohttp.access=0.01")
+# Размер очереди записей; при переполнении записи отбрасываются, а не блокируют цикл событий
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+TEXT_FORMAT = '[%(levelname)s] %(message)s'
+
+_context: ContextVar[Optional[Dict]] = ContextVar("log_context", default=None)
+# Атрибуты, которые есть у любой записи; остальные пришли из extra
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "context"}
+
+
+def bind(**fields):
+    """Добавляет поля ко всем записям текущей задачи (и задач, созданных из неё)."""
+    _context.set({**(_context.get() or {}), **fields})
+
+
+def parse_sampling(value: str) -> Dict[str, float]:
+    rates = {}
+    for item in value.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Переносит контекст задачи в запись: поток вывода его уже не увидит."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = _context.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Прореживает записи INFO и ниже по событию (extra event) или имени логгера."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not self.rates:
+            return True
+        rate = self.rates.get(getattr(record, "event", None) or record.name)
+        if rate is None or rate >= 1:
+            return True
+        user = (record.context or {}).get("user")
+        # Одно и то же решение для всех записей пользователя
+        point = zlib.crc32(str(user).encode()) % 10000 / 10000 if user is not None else random.random()
+        if point < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь без ожидания места в очереди; вывод — в фоновом потоке."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы подставляются здесь, в цикле событий: это живые объекты (ответ API
+        # в кэше, счётчики), и поток вывода увидел бы их уже изменёнными. Сюда доходят
+        # только записи, прошедшие уровень и прореживание; оформление и вывод — в потоке
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись одной строкой JSON: время, уровень, логгер, сообщение, контекст и поля из extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        data.update(getattr(record, "context", None) or {})
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат; cid обновления добавляется в конец строки."""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        context = getattr(record, "context", None)
+        return f"{line} [{context['cid']}]" if context and "cid" in context else line
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Задаёт cid и пользователя для записей, сделанных при обработке сообщения, и состояние FSM."""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        update = types.Update.get_current()
+        user = message.from_user.id if message.from_user else None
+        bind(cid=f"{user}-{update.update_id if update else message.message_id}", user=user)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        bind(state=data.get("raw_state"))
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[BackgroundQueueHandler] = None
+_sampling: Optional[SamplingFilter] = None
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, sampling: str = LOG_SAMPLING):
+    """Направляет все логгеры процесса в очередь с фоновым потоком вывода (повторный вызов ничего не делает)."""
+    global _listener, _handler, _sampling
+    if _listener is not None:
+        return
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    _handler = BackgroundQueueHandler(log_queue)
+    _handler.addFilter(ContextFilter())
+    _sampling = SamplingFilter(parse_sampling(sampling))
+    _handler.addFilter(_sampling)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def stats() -> Dict:
+    return {
+        "queued": _handler.queue.qsize() if _handler else 0,
+        "dropped_full": _handler.dropped if _handler else 0,
+        "dropped_sampled": _sampling.dropped if _sampling else 0,
+    }
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from aiohttp import web
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Порт HTTP-эндпоинта /metrics (0 — не запускать); воркеры webhook-режима занимают порт + номер воркера
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Период замера задержки цикла событий, секунды
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+# Границы корзин гистограмм времени, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами; observe() — один bisect и два сложения."""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Для каждого набора меток: счётчики по корзинам (последняя — +Inf), сумма, количество
+        self.series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, key: LabelValues, q: float) -> float:
+        """Оценка квантиля по корзинам (верхняя граница корзины, в которую он попадает)."""
+        counts, _, total = self.series[key]
+        threshold, running = q * total, 0
+        for index, count in enumerate(counts):
+            running += count
+            if running >= threshold:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def summary(self) -> Dict[LabelValues, Dict[str, float]]:
+        return {
+            key: {"count": total, "mean": value_sum / total if total else 0.0,
+                  "p50": self.quantile(key, 0.5), "p95": self.quantile(key, 0.95)}
+            for key, (_, value_sum, total) in self.series.items()
+        }
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, value_sum, total) in self.series.items():
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                running += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labels + ("le",), key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {running}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {value_sum}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {total}")
+        return lines
+
+
+class Registry:
+    """
+    Набор метрик процесса.
+
+    Кроме счётчиков и гистограмм принимает сборщики — функции, возвращающие
+    словарь чисел (или словарь словарей: внешний ключ становится меткой key).
+    Они вызываются только при выдаче метрик и превращаются в gauge.
+    """
+
+    def __init__(self):
+        self.metrics: List = []
+        self.collectors: Dict[str, Callable[[], Dict]] = {}
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (), **kwargs) -> Histogram:
+        metric = Histogram(name, help_text, labels, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, name: str, collect: Callable[[], Dict]):
+        self.collectors[name] = collect
+
+    def collect(self) -> Dict[str, Dict]:
+        values = {}
+        for name, collect in self.collectors.items():
+            try:
+                values[name] = collect()
+            except Exception as e:
+                logger.error("Ошибка сборщика метрик %s: %s", name, e)
+        return values
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, stats in self.collect().items():
+            for field, value in stats.items():
+                if isinstance(value, dict):
+                    for sub_field, sub_value in value.items():
+                        if isinstance(sub_value, (int, float)) and not isinstance(sub_value, bool):
+                            lines.append(f'bot_{name}_{sub_field}{{key="{field}"}} {sub_value}')
+                elif isinstance(value, (int, float)):
+                    lines.append(f"bot_{name}_{field} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_LATENCY = registry.histogram(
+    "bot_handler_seconds", "Время обработки сообщения хендлером", ["handler", "state"])
+UPSTREAM_LATENCY = registry.histogram(
+    "bot_upstream_seconds", "Время запросов к внешним API", ["service", "outcome"])
+SQLITE_LATENCY = registry.histogram(
+    "bot_sqlite_seconds", "Время операций с SQLite", ["operation"])
+LOOP_LAG = registry.histogram(
+    "bot_event_loop_lag_seconds", "Задержка пробуждения цикла событий")
+UPDATES = registry.counter("bot_updates_total", "Обработанные сообщения", ["handler"])
+SEND_LATENCY = registry.histogram(
+    "bot_send_seconds", "Время от постановки сообщения в очередь до отправки в Telegram", ["method"])
+SEND_RESULTS = registry.counter("bot_send_total", "Результаты отправки сообщений", ["outcome"])
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет время обработки каждого сообщения с разбивкой по хендлеру и состоянию FSM."""
+
+    async def on_pre_process_message(self, message, data: dict):
+        data["_metrics_started"] = time.perf_counter()
+
+    async def on_process_message(self, message, data: dict):
+        data["_metrics_handler"] = current_handler.get().__name__
+
+    async def on_post_process_message(self, message, results, data: dict):
+        started = data.get("_metrics_started")
+        if started is None:
+            return
+        handler = data.get("_metrics_handler", "unhandled")
+        latency = time.perf_counter() - started
+        HANDLER_LATENCY.observe(latency, handler=handler, state=data.get("raw_state") or "-")
+        UPDATES.inc(handler=handler)
+        logger.info("%s обработано за %.1f мс", handler, latency * 1000,
+                    extra={"event": "update", "handler": handler, "latency": latency})
+
+
+async def _monitor_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+class MetricsServer:
+    """
+    HTTP-эндпоинт /metrics в формате Prometheus и фоновый замер задержки цикла событий.
+    Если передан ready, эндпоинт /ready отвечает 200 после прогрева процесса и 503 до него.
+    """
+
+    def __init__(self, port: int = METRICS_PORT, host: str = METRICS_HOST,
+                 ready: Optional[Callable[[], bool]] = None):
+        self.port = port
+        self.host = host
+        self.ready = ready
+        self._runner: Optional[web.AppRunner] = None
+        self._lag_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._lag_task = asyncio.ensure_future(_monitor_loop_lag())
+        if not self.port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", _handle_metrics)
+        if self.ready is not None:
+            app.router.add_get("/ready", self._handle_ready)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Метрики доступны на http://%s:%s/metrics", self.host, self.port)
+
+    async def _handle_ready(self, request: web.Request) -> web.Response:
+        if self.ready():
+            return web.Response(text="ready")
+        return web.Response(status=503, text="warming up")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def _format_seconds(value: float) -> str:
+    return "∞" if value == float("inf") else f"{value * 1000:.0f} мс"
+
+
+def format_stats() -> str:
+    """Краткая сводка метрик для команды /stats."""
+    lines = ["Хендлеры (кол-во, p50, p95):"]
+    for (handler, state), stats in sorted(HANDLER_LATENCY.summary().items()):
+        lines.append(f"  {handler} [{state}]: {stats['count']}, "
+                     f"{_format_seconds(stats['p50'])}, {_format_seconds(stats['p95'])}")
+    lines.append("Внешние API (кол-во, p50, p95):")
+    for (service, outcome), stats in sorted(UPSTREAM_LATENCY.summary().items()):
+        lines.append(f"  {service} {outcome}: {stats['count']}, "
+                     f"{_format_seconds(stats['p50'])}, {_format_seconds(stats['p95'])}")
+    lines.append("Отправка в Telegram (кол-во, p50, p95):")
+    for (method,), stats in sorted(SEND_LATENCY.summary().items()):
+        lines.append(f"  {method}: {stats['count']}, "
+                     f"{_format_seconds(stats['p50'])}, {_format_seconds(stats['p95'])}")
+    lag = LOOP_LAG.summary().get(())
+    if lag:
+        lines.append(f"Задержка цикла событий: p95 {_format_seconds(lag['p95'])}")
+    for name, stats in registry.collect().items():
+        flat = {k: v for k, v in stats.items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+        if flat:
+            lines.append(f"{name}: " + ", ".join(
+                f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in flat.items()))
+    return "\n".join(lines)
@@ -0,0 +1,73 @@
+from typing import Dict, Mapping, NamedTuple, Tuple
+from rates import RateSnapshot
+
+
+class Region(NamedTuple):
+    """
+    Регион покупки: валюта цены, комиссии в валюте, пункт назначения доставки и
+    диапазон типичных цен в валюте региона (узлы сетки предрасчёта, quote_grid).
+    """
+    currency: str
+    cny: float
+    usd: float
+    rub: float
+    destination: str
+    price_range: Tuple[float, float]
+
+
+# Регионы в порядке кнопок. Новый регион добавляется строкой здесь: кнопки, проверка
+# ответов, валюта запроса и ответ пользователю строятся по этой таблице (валюта должна
+# быть в rates.CURRENCIES). Строка комиссии в юанях показывается, если она не нулевая.
+REGIONS = {
+    "Китай": Region("CNY", 16000, 3900, 50000, "Перми", (20000.0, 2000000.0)),
+    "Корея": Region("KRW", 0, 2500, 150000, "Владивостока", (5000000.0, 300000000.0)),
+}
+# Возраст автомобиля в порядке кнопок
+AGES = ("до 3", "3-5")
+# Типы двигателя: кнопка → значение для API
+ENGINE_TYPES = {
+    "Бензиновый": "gasoline",
+    "Дизельный": "diesel",
+    "Гибридный": "hybrid",
+    "Электрический": "electric",
+}
+# Типы двигателя, для которых объём не спрашивается и считается нулевым
+ENGINES_WITHOUT_CAPACITY = frozenset({"electric"})
+
+
+class Commission(NamedTuple):
+    """Комиссии региона в рублях по одному снимку курсов."""
+    cny_fee: float
+    usd_fee: float
+    rub_fee: float
+    destination: str
+
+    @property
+    def russia_fee(self) -> float:
+        return self.rub_fee + self.usd_fee
+
+    @property
+    def total(self) -> float:
+        return self.cny_fee + self.usd_fee + self.rub_fee
+
+
+def region_commission(region: str, rates: RateSnapshot) -> Commission:
+    fees = REGIONS[region]
+    return Commission(fees.cny * rates.rub("CNY"), fees.usd * rates.rub("USD"), fees.rub, fees.destination)
+
+
+def all_commissions(rates: RateSnapshot) -> Dict[str, Commission]:
+    """Комиссии всех регионов сразу — для пакетных расчётов по одному снимку курсов."""
+    return {region: region_commission(region, rates) for region in REGIONS}
+
+
+def quote_params(data: Mapping) -> dict:
+    """Параметры запроса к API из собранных ответов пользователя."""
+    return {
+        "vehicle_age": data["vehicle_age"],
+        "engine_type": data["engine_type"],
+        "engine_power": data["engine_power"],
+        "engine_capacity": data["engine_capacity"],
+        "vehicle_price": data["vehicle_price"],
+        "currency": REGIONS[data["region"]].currency
+    }
@@ -0,0 +1,116 @@
+import re
+from typing import Dict, List
+from pricing import REGIONS, AGES, ENGINE_TYPES, ENGINES_WITHOUT_CAPACITY
+
+# Синонимы, которые понимает быстрый расчёт (регистр не важен); подписи кнопок
+# из таблиц pricing понимаются всегда
+REGION_ALIASES = {
+    **{region.lower(): region for region in REGIONS},
+    "china": "Китай", "cn": "Китай",
+    "korea": "Корея", "kr": "Корея",
+}
+AGE_ALIASES = {
+    **{age.replace(" ", ""): age for age in AGES},
+    "0-3": "до 3", "<3": "до 3",
+}
+ENGINE_ALIASES = {
+    **{label.lower(): engine for label, engine in ENGINE_TYPES.items()},
+    **{engine: engine for engine in ENGINE_TYPES.values()},
+    "petrol": "gasoline", "бензин": "gasoline",
+    "дизель": "diesel",
+    "гибрид": "hybrid",
+    "ev": "electric", "электро": "electric",
+}
+
+# Свободный текст считается запросом быстрого расчёта, если начинается с региона
+QUICK_QUOTE_PATTERN = r'(?i)^\s*(' + '|'.join(map(re.escape, REGION_ALIASES)) + r')\s'
+
+USAGE = (
+    "Формат: /calc <регион> <возраст> <двигатель> <объём> <мощность> <цена>\n"
+    "Например: /calc china 3-5 gasoline 1998 150 210000\n"
+    "Для электромобиля объём можно не указывать: /calc korea до3 electric 300 45000000"
+)
+
+_NUMBER_RE = re.compile(r'^\d+(\.\d+)?$')
+
+
+def _number(value) -> float:
+    text = str(value).strip()
+    if not _NUMBER_RE.match(text):
+        raise ValueError(f"«{text}» — не число.")
+    return float(text)
+
+
+def validate_quote(region, age, engine, capacity, power, price) -> Dict:
+    """
+    Проверяет параметры расчёта по тем же правилам, что пошаговый диалог:
+    допустимые значения из клавиатур (или их синонимы) и положительные числа.
+    У электромобиля объём не учитывается и может быть пустым.
+
+    Returns:
+        Словарь с ключами region, vehicle_age, engine_type, engine_capacity, engine_power, vehicle_price.
+
+    Raises:
+        ValueError: Если параметр недопустим; текст ошибки можно показать пользователю.
+    """
+    fields = {
+        "region": REGION_ALIASES.get(str(region).strip().lower()),
+        "vehicle_age": AGE_ALIASES.get(re.sub(r'до\s+3', 'до3', str(age).strip().lower())),
+        "engine_type": ENGINE_ALIASES.get(str(engine).strip().lower()),
+    }
+    for key, name, value in (("region", "регион", region), ("vehicle_age", "возраст", age),
+                             ("engine_type", "тип двигателя", engine)):
+        if fields[key] is None:
+            raise ValueError(f"Неизвестный {name}: «{value}».")
+
+    if fields["engine_type"] in ENGINES_WITHOUT_CAPACITY:
+        capacity = 0
+    else:
+        capacity = _number(capacity)
+        if capacity <= 0:
+            raise ValueError("Объём должен быть положительным.")
+    power, price = _number(power), _number(price)
+    if power <= 0:
+        raise ValueError("Мощность должна быть положительной.")
+    if price <= 0:
+        raise ValueError("Стоимость должна быть положительной.")
+
+    fields.update(engine_capacity=capacity, engine_power=power, vehicle_price=price)
+    return fields
+
+
+def parse_quick_quote(text: str) -> Dict:
+    """
+    Разбирает запрос быстрого расчёта в один проход.
+
+    Слова (регион, возраст, тип двигателя) могут идти в любом порядке, числа —
+    строго в порядке объём, мощность, цена. Проверки — как в validate_quote().
+
+    Raises:
+        ValueError: Если запрос не удалось разобрать; текст ошибки можно показать пользователю.
+    """
+    normalized = re.sub(r'до\s+3', 'до3', text.lower())
+    words = {}
+    numbers: List[str] = []
+    for token in normalized.split():
+        if token in REGION_ALIASES:
+            words["region"] = token
+        elif token in AGE_ALIASES:
+            words["age"] = token
+        elif token in ENGINE_ALIASES:
+            words["engine"] = token
+        elif _NUMBER_RE.match(token):
+            numbers.append(token)
+        else:
+            raise ValueError(f"Не удалось распознать «{token}».\n{USAGE}")
+
+    missing = [name for key, name in (("region", "регион"), ("age", "возраст"),
+                                      ("engine", "тип двигателя")) if key not in words]
+    if missing:
+        raise ValueError(f"Не указаны: {', '.join(missing)}.\n{USAGE}")
+
+    if ENGINE_ALIASES[words["engine"]] in ENGINES_WITHOUT_CAPACITY and len(numbers) == 2:
+        numbers.insert(0, "0")
+    if len(numbers) != 3:
+        raise ValueError(f"Нужно три числа: объём, мощность и цена.\n{USAGE}")
+    return validate_quote(words["region"], words["age"], words["engine"], *numbers)
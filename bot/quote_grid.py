@@ -0,0 +1,349 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+import convector
+from api_client import _normalize
+from local_engine import LocalCustomsEngine
+from pricing import REGIONS, AGES, ENGINE_TYPES
+from quote_log import mark_source
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Источник сетки: local — локальные тарифы, calcus — запросы к API (пусто — сетка выключена)
+QUOTE_GRID_SOURCE = os.getenv("QUOTE_GRID_SOURCE", "")
+QUOTE_GRID_FILE = os.getenv("QUOTE_GRID_FILE", "quote_grid.npz")
+# Как часто проверять, что сетка построена по текущим курсам, секунды
+QUOTE_GRID_CHECK_INTERVAL = float(os.getenv("QUOTE_GRID_CHECK_INTERVAL", "60"))
+# Лимит запросов к API при построении сетки из calcus, в секунду
+QUOTE_GRID_RATE_LIMIT = float(os.getenv("QUOTE_GRID_RATE_LIMIT", "2"))
+# Узлы сетки: частые объёмы и мощности (совпадение точное) и число узлов цены на валюту
+QUOTE_GRID_CAPACITIES = os.getenv(
+    "QUOTE_GRID_CAPACITIES", "999,1199,1395,1498,1598,1798,1968,1995,1998,1999,2000,2487,2494,2497,2998,3000")
+QUOTE_GRID_POWERS = os.getenv("QUOTE_GRID_POWERS", "100,110,120,136,150,163,170,184,190,200,249,250,300")
+QUOTE_GRID_PRICE_POINTS = int(os.getenv("QUOTE_GRID_PRICE_POINTS", "48"))
+# Узлы сетки из calcus: каждая точка — запрос к API (ячейки × (2 × узлы цены − 1)), поэтому
+# по умолчанию их намного меньше: 1 800 запросов, около 15 минут при 2 запросах в секунду
+QUOTE_GRID_REMOTE_CAPACITIES = os.getenv("QUOTE_GRID_REMOTE_CAPACITIES", "1598,1998,2497")
+QUOTE_GRID_REMOTE_POWERS = os.getenv("QUOTE_GRID_REMOTE_POWERS", "150,190,249")
+QUOTE_GRID_REMOTE_PRICE_POINTS = int(os.getenv("QUOTE_GRID_REMOTE_PRICE_POINTS", "8"))
+
+# Диапазоны цен (в валюте покупки) из таблицы регионов, узлы внутри расположены в
+# геометрической прогрессии
+PRICE_RANGES = {region.currency: region.price_range for region in REGIONS.values()}
+ENGINES = tuple(ENGINE_TYPES.values())
+GRID_FIELDS = ("sbor", "tax", "util", "total", "total2")
+# Допустимое отклонение середины интервала от линейной интерполяции, рубли
+LINEAR_TOLERANCE = 0.01
+
+
+def _parse_points(value: str) -> Tuple[float, ...]:
+    return tuple(sorted({float(v) for v in value.split(",") if v.strip()}))
+
+
+class GridAxes(NamedTuple):
+    currencies: Tuple[str, ...]
+    ages: Tuple[str, ...]
+    engines: Tuple[str, ...]
+    capacities: Tuple[float, ...]
+    powers: Tuple[float, ...]
+    price_points: int
+
+    @classmethod
+    def default(cls, source: str = "local") -> "GridAxes":
+        if source == "calcus":
+            return cls(tuple(PRICE_RANGES), AGES, ENGINES, _parse_points(QUOTE_GRID_REMOTE_CAPACITIES),
+                       _parse_points(QUOTE_GRID_REMOTE_POWERS), QUOTE_GRID_REMOTE_PRICE_POINTS)
+        return cls(tuple(PRICE_RANGES), AGES, ENGINES, _parse_points(QUOTE_GRID_CAPACITIES),
+                   _parse_points(QUOTE_GRID_POWERS), QUOTE_GRID_PRICE_POINTS)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (len(self.currencies), len(self.ages), len(self.engines),
+                len(self.capacities), len(self.powers))
+
+    def prices(self, currency: str) -> np.ndarray:
+        low, high = PRICE_RANGES[currency]
+        return np.geomspace(low, high, self.price_points)
+
+    def samples(self) -> int:
+        """Сколько расчётов нужно для построения: ячейки × (узлы цены + середины интервалов)."""
+        return len(_grid_lines(self)) * (2 * self.price_points - 1)
+
+
+class QuoteGrid:
+    """
+    Предрасчитанные результаты для частых сочетаний параметров.
+
+    Значения хранятся в одном массиве формы (валюта, возраст, двигатель, объём, мощность,
+    узел цены, поле). Объём и мощность ищутся по точному совпадению со словарём узлов,
+    узел цены вычисляется по логарифму цены, поэтому поиск — O(1). Между узлами цены
+    значения интерполируются линейно, но только на интервалах, где при построении
+    середина интервала совпала с интерполяцией (внутри нет границ тарифных ступеней);
+    иначе поиск возвращает None и расчёт идёт обычным путём.
+    """
+
+    def __init__(self, axes: GridAxes, values: np.ndarray, linear: np.ndarray, meta: Dict):
+        self.axes = axes
+        self.values = values
+        self.linear = linear
+        self.meta = meta
+        self._index = [{value: i for i, value in enumerate(axis)} for axis in axes[:5]]
+        self._price_low = {c: PRICE_RANGES[c][0] for c in axes.currencies}
+        self._log_step = {c: math.log(PRICE_RANGES[c][1] / PRICE_RANGES[c][0]) / (axes.price_points - 1)
+                          for c in axes.currencies}
+        self._prices = {c: axes.prices(c).tolist() for c in axes.currencies}
+
+    def matches(self, snapshot) -> bool:
+        """Построена ли сетка по этому снимку курсов."""
+        return self.meta.get("rates_date") == snapshot.date and self.meta.get("rates_ts") == snapshot.fetched_at
+
+    def _cell(self, params: Dict) -> Optional[Tuple[int, ...]]:
+        currencies, ages, engines, capacities, powers = self._index
+        engine = engines.get(params.get("engine_type"))
+        try:
+            capacity = 0 if params.get("engine_type") == "electric" else capacities.get(float(params["engine_capacity"]))
+            power = powers.get(float(params["engine_power"]))
+        except (KeyError, TypeError, ValueError):
+            return None
+        cell = (currencies.get(params.get("currency")), ages.get(params.get("vehicle_age")), engine, capacity, power)
+        return None if None in cell else cell
+
+    def lookup(self, params: Dict) -> Optional[Dict]:
+        """Результат из сетки или None, если параметры вне сетки или рядом с границей ступени тарифа."""
+        cell = self._cell(params)
+        if cell is None:
+            return None
+        currency = params["currency"]
+        try:
+            price = float(params["vehicle_price"])
+        except (TypeError, ValueError):
+            return None
+        if price <= 0:
+            return None
+        position = math.log(price / self._price_low[currency]) / self._log_step[currency]
+        node = round(position)
+        if abs(position - node) < 1e-9 and 0 <= node < self.axes.price_points:
+            row = self.values[cell + (node,)].tolist()
+        else:
+            left = math.floor(position)
+            if left < 0 or left >= self.axes.price_points - 1 or not self.linear[cell + (left,)]:
+                return None
+            prices = self._prices[currency]
+            weight = (price - prices[left]) / (prices[left + 1] - prices[left])
+            low, high = self.values[cell][left:left + 2].tolist()
+            row = [a + (b - a) * weight for a, b in zip(low, high)]
+        if any(math.isnan(value) for value in row):
+            return None
+        return {field: round(value, 2) for field, value in zip(GRID_FIELDS, row)}
+
+    def stats(self) -> Dict:
+        return {
+            "cells": int(self.values[..., 0].size),
+            "linear_share": float(self.linear.mean()) if self.linear.size else 0.0,
+            "size_bytes": int(self.values.nbytes + self.linear.nbytes),
+            "build_seconds": self.meta.get("build_seconds", 0.0),
+        }
+
+    def save(self, path: str):
+        meta = dict(self.meta, axes=self.axes._asdict())
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".quote-grid-", suffix=".npz")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, values=self.values, linear=self.linear, meta=np.array(json.dumps(meta)))
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> Optional["QuoteGrid"]:
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                meta = json.loads(str(data["meta"]))
+                axes = GridAxes(**{k: tuple(v) if isinstance(v, list) else v for k, v in meta.pop("axes").items()})
+                return cls(axes, data["values"], data["linear"], meta)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error("Ошибка при загрузке сетки расчётов: %s", e)
+            return None
+
+
+def _grid_lines(axes: GridAxes) -> List[Tuple[Tuple[int, ...], Dict]]:
+    """Наборы параметров без цены для каждой ячейки; у электромобиля объём не влияет — одна ячейка на мощность."""
+    lines = []
+    for ci, currency in enumerate(axes.currencies):
+        for ai, age in enumerate(axes.ages):
+            for ei, engine in enumerate(axes.engines):
+                capacities = [(0, 0)] if engine == "electric" else list(enumerate(axes.capacities))
+                for vi, capacity in capacities:
+                    for pi, power in enumerate(axes.powers):
+                        lines.append(((ci, ai, ei, vi, pi), {
+                            "vehicle_age": age, "engine_type": engine, "engine_capacity": _normalize(capacity),
+                            "engine_power": _normalize(power), "currency": currency}))
+    return lines
+
+
+def _sample_prices(prices: np.ndarray) -> np.ndarray:
+    """Узлы цены вперемешку с серединами интервалов: p0, (p0+p1)/2, p1, ..."""
+    samples = np.empty(2 * len(prices) - 1)
+    samples[0::2] = prices
+    samples[1::2] = (prices[:-1] + prices[1:]) / 2
+    return samples
+
+
+def _finish(axes: GridAxes, samples: np.ndarray, meta: Dict) -> QuoteGrid:
+    """Разделяет узлы и середины и векторно проверяет линейность каждого интервала цены."""
+    values = np.ascontiguousarray(samples[..., 0::2, :])
+    middles = samples[..., 1::2, :]
+    chords = (values[..., :-1, :] + values[..., 1:, :]) / 2
+    linear = np.all(np.abs(middles - chords) <= LINEAR_TOLERANCE + 1e-9 * np.abs(middles), axis=-1)
+    return QuoteGrid(axes, values, linear, meta)
+
+
+def _store(samples: np.ndarray, cell: Tuple[int, ...], index: int, result: Optional[Dict]):
+    if result:
+        samples[cell + (index,)] = [result[field] for field in GRID_FIELDS]
+
+
+def build_local(axes: GridAxes, snapshot) -> QuoteGrid:
+    """Строит сетку по локальным тарифам и курсам снимка (синхронно, для запуска в пуле потоков)."""
+    started = time.perf_counter()
+    engine = LocalCustomsEngine(rate_provider=lambda: snapshot.rates)
+    samples = np.full(axes.shape + (2 * axes.price_points - 1, len(GRID_FIELDS)), np.nan)
+    for cell, params in _grid_lines(axes):
+        for index, price in enumerate(_sample_prices(axes.prices(params["currency"]))):
+            try:
+                _store(samples, cell, index, engine.calculate(dict(params, vehicle_price=float(price))))
+            except (KeyError, TypeError, ValueError):
+                pass
+    return _finish(axes, samples, {"source": "local", "rates_date": snapshot.date, "rates_ts": snapshot.fetched_at,
+                                   "build_seconds": time.perf_counter() - started})
+
+
+async def build_remote(axes: GridAxes, snapshot, client, limiter: TokenBucket) -> QuoteGrid:
+    """
+    Строит сетку запросами к API с ограничением частоты. Число запросов — axes.samples(),
+    поэтому для calcus узлы сетки задаются отдельно и небольшими (QUOTE_GRID_REMOTE_*).
+    """
+    started = time.perf_counter()
+    samples = np.full(axes.shape + (2 * axes.price_points - 1, len(GRID_FIELDS)), np.nan)
+    for cell, params in _grid_lines(axes):
+        for index, price in enumerate(_sample_prices(axes.prices(params["currency"]))):
+            await limiter.acquire()
+            _store(samples, cell, index, await client.calculate_customs(dict(params, vehicle_price=float(price))))
+    return _finish(axes, samples, {"source": "calcus", "rates_date": snapshot.date, "rates_ts": snapshot.fetched_at,
+                                   "build_seconds": time.perf_counter() - started})
+
+
+class GridCustomsClient:
+    """
+    Обёртка над клиентом расчёта: отвечает из сетки, если она построена по текущим
+    курсам и параметры попадают в неё, иначе передаёт запрос дальше.
+
+    Сетка из calcus строится запросами через remote_client — клиент ниже кэша
+    результатов, чтобы тысячи точек сетки не вытесняли из него расчёты пользователей.
+    """
+
+    def __init__(self, client, source: str = QUOTE_GRID_SOURCE, path: str = QUOTE_GRID_FILE,
+                 axes: Optional[GridAxes] = None, remote_client=None):
+        self.client = client
+        self.remote_client = remote_client or client
+        self.source = source
+        self.path = path
+        self.axes = axes or GridAxes.default(source)
+        self.grid: Optional[QuoteGrid] = None
+        # Идущее построение: пока оно не закончилось, refresh новое не начинает
+        self._build: Optional[asyncio.Future] = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    async def calculate_customs(self, params: Dict, **kwargs) -> Optional[Dict]:
+        grid = self.grid
+        if grid is None or not grid.matches(convector.rate_store.current()):
+            self.stale += 1
+        else:
+            result = grid.lookup(params)
+            if result is not None:
+                self.hits += 1
+                mark_source("grid")
+                return result
+            self.misses += 1
+        return await self.client.calculate_customs(params, **kwargs)
+
+    async def refresh(self, primary: bool = True):
+        """
+        Приводит сетку в соответствие с текущими курсами: берёт файл, если он построен по ним,
+        иначе (только в основном процессе) строит заново и сохраняет для остальных воркеров.
+
+        Локальная сетка строится в пуле потоков, и refresh ждёт её. Построение из calcus
+        идёт минуты, поэтому запускается в фоне: refresh (и шаг прогрева) не ждёт его,
+        а до готовности запросы идут обычным путём.
+        """
+        if self._build is not None and not self._build.done():
+            return
+        snapshot = convector.rate_store.current()
+        if self.grid is not None and self.grid.matches(snapshot):
+            return
+        grid = QuoteGrid.load(self.path)
+        if grid is not None and grid.matches(snapshot) and grid.axes == self.axes:
+            self.grid = grid
+            logger.info("Сетка расчётов загружена из %s", self.path)
+            return
+        if not primary:
+            return
+        if self.source == "calcus":
+            self._build = asyncio.ensure_future(self._build_remote(snapshot))
+            return
+        loop = asyncio.get_event_loop()
+        self._build = loop.run_in_executor(None, build_local, self.axes, snapshot)
+        self._install(await self._build)
+
+    async def _build_remote(self, snapshot):
+        logger.info("Построение сетки из calcus.ru: %s запросов, не больше %s в секунду",
+                    self.axes.samples(), QUOTE_GRID_RATE_LIMIT)
+        try:
+            grid = await build_remote(self.axes, snapshot, self.remote_client, TokenBucket(QUOTE_GRID_RATE_LIMIT))
+        except Exception as e:
+            logger.error("Ошибка построения сетки расчётов из calcus.ru: %s", e)
+            return
+        self._install(grid)
+
+    def _install(self, grid: QuoteGrid):
+        self.grid = grid
+        try:
+            grid.save(self.path)
+        except OSError as e:
+            logger.error("Ошибка при сохранении сетки расчётов: %s", e)
+        logger.info("Сетка расчётов построена (%s) за %.1f с: %s",
+                    grid.meta['source'], grid.meta['build_seconds'], grid.stats())
+
+    def stats(self) -> Dict:
+        stats = {"hits": self.hits, "misses": self.misses, "stale": self.stale}
+        if self.grid is not None:
+            stats.update(self.grid.stats())
+        return stats
+
+    async def close(self):
+        if self._build is not None:
+            self._build.cancel()
+        await self.client.close()
+
+
+def schedule_grid_tasks(scheduler, client, primary: bool = True):
+    """
+    Планирует проверку сетки: после каждого обновления курсов она перестраивается или перечитывается.
+    Первую загрузку выполняет прогрев при запуске (шаг quote_grid в bot.py).
+    """
+    if not isinstance(client, GridCustomsClient):
+        return
+    scheduler.every(QUOTE_GRID_CHECK_INTERVAL, "refresh_quote_grid", lambda: client.refresh(primary))
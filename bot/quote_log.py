@@ -0,0 +1,269 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextvars import ContextVar
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from api_client import map_params
+from batch_writer import SQLiteBatchWriter
+from convector import rate_store
+from metrics import SQLITE_LATENCY
+from pricing import quote_params, region_commission
+from scheduler import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Журнал расчётов (пусто — не вести)
+QUOTE_LOG_DB = os.getenv("QUOTE_LOG_DB", "quote_log.db")
+# Сколько дней хранить журнал
+QUOTE_LOG_RETENTION_DAYS = int(os.getenv("QUOTE_LOG_RETENTION_DAYS", "90"))
+# Как часто накопленные записи пишутся в базу, секунды
+QUOTE_LOG_FLUSH_INTERVAL = float(os.getenv("QUOTE_LOG_FLUSH_INTERVAL", "5"))
+# Сколько записей держать в памяти, пока база недоступна (старые отбрасываются)
+QUOTE_LOG_MAX_BUFFER = int(os.getenv("QUOTE_LOG_MAX_BUFFER", "10000"))
+# Расписание удаления старых дней (cron)
+QUOTE_LOG_CLEANUP_CRON = os.getenv("QUOTE_LOG_CLEANUP_CRON", "30 9 * * *")
+
+# Таблица на каждый день: quotes_20240131
+TABLE_PREFIX = "quotes_"
+_TABLE_RE = re.compile(r"^quotes_(\d{8})$")
+COLUMNS = ("created", "user_id", "channel", "region", "age", "engine", "capacity", "power", "price",
+           "currency", "params", "result", "rates", "total", "latency", "source")
+
+# Кто ответил на текущий расчёт: api, cache, stale, local, grid. Слои клиента отмечают
+# ответ, данный ими самими; вызовы идут в задаче хендлера, так что отметка видна ему.
+_quote_source: ContextVar[str] = ContextVar("quote_source", default="api")
+
+
+def mark_source(source: str):
+    """Отмечает, какой слой клиента дал ответ на текущий расчёт."""
+    _quote_source.set(source)
+
+
+def _table(day: date) -> str:
+    return f"{TABLE_PREFIX}{day:%Y%m%d}"
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class QuoteLog(SQLiteBatchWriter):
+    """
+    Журнал расчётов только на добавление.
+
+    record() кладёт запись в буфер без обращения к диску, flush() пачкой пишет буфер
+    в SQLite одной транзакцией (см. SQLiteBatchWriter). Записи каждого дня лежат в своей таблице с индексами
+    по пользователю и времени, поэтому удаление старых данных — DROP TABLE, а не
+    DELETE с просмотром всего журнала. Отчёт читает базу отдельным соединением в
+    потоке, не задерживая цикл событий.
+    """
+
+    flush_operation = "quote_log_flush"
+
+    def __init__(self, db_file: str = QUOTE_LOG_DB, retention_days: int = QUOTE_LOG_RETENTION_DAYS,
+                 max_buffer: int = QUOTE_LOG_MAX_BUFFER):
+        super().__init__()
+        self.db_file = db_file
+        self.retention_days = retention_days
+        self.max_buffer = max_buffer
+        self._buffer: List[Tuple[str, tuple]] = []
+        self._tables = set()
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+
+    def _connect(self) -> Tuple[sqlite3.Connection, Set[str]]:
+        conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        tables = {name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'quotes_%'")}
+        return conn, tables
+
+    async def open(self):
+        """Открывает базу в потоке ввода-вывода; записанное до этого остаётся в буфере до первой записи."""
+        if not self.db_file or self._conn is not None:
+            return
+        self._conn, self._tables = await run_blocking(self._connect)
+        logger.info("Журнал расчётов: %s, дней: %s", self.db_file, len(self._tables))
+
+    def _create_table(self, table: str):
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                created REAL, user_id INTEGER, channel TEXT,
+                region TEXT, age TEXT, engine TEXT, capacity REAL, power REAL, price REAL, currency TEXT,
+                params TEXT, result TEXT, rates TEXT, total REAL, latency REAL, source TEXT
+            )
+        """)
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_user ON {table} (user_id)")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+
+    def record(self, user_id: int, channel: str, data: Dict, result: Optional[Dict],
+               latency: float, source: str):
+        """Добавляет расчёт в буфер; при неудачном расчёте result — None, а source — error."""
+        if not self.db_file:
+            return
+        params = quote_params(data)
+        snapshot = rate_store.current()
+        total = None
+        if result:
+            total = result["total2"] + region_commission(data["region"], snapshot).total
+        now = time.time()
+        row = (now, user_id, channel, data["region"], data["vehicle_age"], data["engine_type"],
+               data.get("engine_capacity"), data["engine_power"], data["vehicle_price"], params["currency"],
+               json.dumps(map_params(params), ensure_ascii=False), json.dumps(result, ensure_ascii=False),
+               json.dumps(dict(snapshot.rates)), total, latency, source)
+        self._buffer.append((_table(date.fromtimestamp(now)), row))
+        self.recorded += 1
+        if len(self._buffer) > self.max_buffer:
+            overflow = len(self._buffer) - self.max_buffer
+            del self._buffer[:overflow]
+            self.dropped += overflow
+
+    def _pending(self) -> bool:
+        return bool(self._buffer) and self._conn is not None
+
+    def _take(self) -> List[Tuple[str, tuple]]:
+        rows, self._buffer = self._buffer, []
+        return rows
+
+    def _write(self, rows: List[Tuple[str, tuple]]):
+        by_table: Dict[str, List[tuple]] = {}
+        for table, row in rows:
+            by_table.setdefault(table, []).append(row)
+        placeholders = ", ".join("?" * len(COLUMNS))
+        # Созданные таблицы запоминаются только после commit: откат отменяет и CREATE TABLE
+        created = []
+        with self._transaction() as conn:
+            for table, table_rows in by_table.items():
+                if table not in self._tables:
+                    self._create_table(table)
+                    created.append(table)
+                conn.executemany(f"INSERT INTO {table} ({', '.join(COLUMNS)}) VALUES ({placeholders})", table_rows)
+        self._tables.update(created)
+
+    def _write_failed(self, rows: List[Tuple[str, tuple]], error: sqlite3.Error):
+        logger.error("Ошибка при записи журнала расчётов: %s", error)
+        self._buffer = rows + self._buffer
+
+    def _written(self, rows: List[Tuple[str, tuple]]):
+        self.written += len(rows)
+
+    def _drop_before(self, cutoff: str) -> List[str]:
+        with self._transaction() as conn:
+            # Таблицы могли создать и другие процессы
+            tables = [name for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'quotes_%'")]
+            old = sorted(name for name in tables if _TABLE_RE.match(name) and name < cutoff)
+            for table in old:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+        self._tables.difference_update(old)
+        return old
+
+    async def drop_old(self):
+        """Удаляет таблицы дней старше срока хранения (в потоке ввода-вывода)."""
+        if self._conn is None:
+            return
+        cutoff = _table(date.today() - timedelta(days=self.retention_days))
+        with SQLITE_LATENCY.time(operation="quote_log_cleanup"):
+            old = await run_blocking(self._drop_before, cutoff)
+        if old:
+            logger.info("Удалён журнал расчётов за %s дн. до %s", len(old), cutoff[len(TABLE_PREFIX):])
+
+    def _report(self, days: int, top: int) -> Dict:
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        try:
+            tables = {name for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'quotes_%'")}
+            report = {"days": [], "sources": {}, "popular": []}
+            selected = []
+            for offset in range(days - 1, -1, -1):
+                day = date.today() - timedelta(days=offset)
+                table = _table(day)
+                if table not in tables:
+                    continue
+                selected.append(table)
+                count, = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+                latencies = [latency for (latency,) in conn.execute(
+                    f"SELECT latency FROM {table} WHERE source = 'api' ORDER BY latency")]
+                report["days"].append({"date": str(day), "quotes": count, "api_calls": len(latencies),
+                                       "api_p50": _percentile(latencies, 0.5),
+                                       "api_p95": _percentile(latencies, 0.95)})
+            if not selected:
+                return report
+            union = " UNION ALL ".join(
+                f"SELECT region, age, engine, capacity, power, source FROM {table}" for table in selected)
+            report["sources"] = dict(conn.execute(
+                f"SELECT source, COUNT(*) FROM ({union}) GROUP BY source").fetchall())
+            report["popular"] = conn.execute(f"""
+                SELECT region, age, engine, capacity, power, COUNT(*) AS quotes
+                FROM ({union}) WHERE source != 'error'
+                GROUP BY region, age, engine, capacity, power ORDER BY quotes DESC LIMIT ?
+            """, (top,)).fetchall()
+            return report
+        finally:
+            conn.close()
+
+    async def report(self, days: int = 7, top: int = 10) -> Dict:
+        """
+        Сводка за последние days дней: расчёты и задержка calcus.ru по дням, доли
+        источников ответа и top самых частых конфигураций.
+        """
+        await self.flush_in_background()
+        return await asyncio.get_event_loop().run_in_executor(None, self._report, days, top)
+
+    def stats(self) -> Dict:
+        return {"buffered": len(self._buffer), "recorded": self.recorded, "written": self.written,
+                "dropped": self.dropped, "days": len(self._tables)}
+
+    def close(self):
+        self._close_connection()
+
+
+# Общий журнал процесса; база открывается при прогреве
+quote_log = QuoteLog()
+
+
+async def calculate_and_log(client, data: Dict, user_id: int, channel: str) -> Optional[Dict]:
+    """Считает расчёт по данным диалога через client и записывает его в журнал."""
+    mark_source("api")
+    started = time.perf_counter()
+    result = await client.calculate_customs(quote_params(data))
+    quote_log.record(user_id, channel, data, result, time.perf_counter() - started,
+                     _quote_source.get() if result else "error")
+    return result
+
+
+def format_report(report: Dict) -> str:
+    """Отчёт для команды /quotes."""
+    lines = ["Расчёты по дням (всего, запросов к calcus, p50, p95):"]
+    for day in report["days"]:
+        lines.append(f"  {day['date']}: {day['quotes']}, {day['api_calls']}, "
+                     f"{day['api_p50'] * 1000:.0f} мс, {day['api_p95'] * 1000:.0f} мс")
+    if not report["days"]:
+        lines.append("  нет данных")
+    total = sum(report["sources"].values())
+    if total:
+        lines.append("Источник ответа: " + ", ".join(
+            f"{source} {count * 100 / total:.0f}%" for source, count in sorted(report["sources"].items())))
+    if report["popular"]:
+        lines.append("Популярные конфигурации:")
+        for region, age, engine, capacity, power, count in report["popular"]:
+            capacity = f"{capacity:g} см³, " if capacity else ""
+            lines.append(f"  {region}, {age}, {engine}, {capacity}{power:g} л.с.: {count}")
+    return "\n".join(lines)
+
+
+def schedule_quote_log_tasks(scheduler):
+    """Планирует запись журнала на диск и удаление старых дней."""
+    if not quote_log.db_file:
+        return
+    scheduler.every(QUOTE_LOG_FLUSH_INTERVAL, "flush_quote_log", quote_log.flush_in_background)
+    scheduler.cron(QUOTE_LOG_CLEANUP_CRON, "drop_old_quote_log", quote_log.drop_old)
@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import date
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional
+import aiohttp
+from metrics import UPSTREAM_LATENCY
+from resilience import ClientRequestError
+
+logger = logging.getLogger(__name__)
+
+# Версия формата файла с курсами
+FORMAT_VERSION = 1
+# Валюты, курсы которых к рублю хранит бот
+CURRENCIES = ("USD", "EUR", "CNY", "KRW")
+# Курсы по умолчанию, если нет ни файла, ни ответа API
+DEFAULT_RATES = {"RUB": 1.0, "USD": 85.0, "EUR": 92.0, "CNY": 11.0, "KRW": 0.062}
+
+
+class RateSnapshot(NamedTuple):
+    """Неизменяемый набор курсов к рублю, полученный одним запросом к API."""
+    date: str
+    fetched_at: float
+    rates: Mapping[str, float]
+
+    def rub(self, currency: str) -> float:
+        """Сколько рублей стоит единица валюты."""
+        return self.rates[currency]
+
+    def is_fresh(self) -> bool:
+        return self.date == str(date.today())
+
+
+def _make_snapshot(day: str, fetched_at: float, rates: Dict[str, float]) -> RateSnapshot:
+    return RateSnapshot(day, fetched_at, MappingProxyType(dict(rates)))
+
+
+class RateStore:
+    """
+    Хранилище курсов валют.
+
+    Читатели получают текущий снимок через current() без блокировок: снимок
+    неизменяем, а обновление подменяет ссылку на него одним присваиванием.
+    Снимок сохраняется в один JSON-файл через запись во временный файл и
+    атомарное переименование.
+    """
+
+    def __init__(self, path: str, api_url: str, timeout: float = 10, currencies=CURRENCIES):
+        self.path = path
+        self.api_url = api_url
+        self.timeout = timeout
+        self.currencies = currencies
+        self._snapshot = _make_snapshot("", 0.0, DEFAULT_RATES)
+        # Время изменения файла, из которого загружен текущий снимок
+        self._mtime: Optional[int] = None
+
+    def current(self) -> RateSnapshot:
+        return self._snapshot
+
+    def load(self) -> bool:
+        """
+        Загружает снимок из файла.
+
+        Returns:
+            True, если в файле курсы за сегодняшний день.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get("v") != FORMAT_VERSION:
+                logger.warning("Неизвестная версия файла курсов: %s", data.get('v'))
+                return False
+            rates = dict(DEFAULT_RATES)
+            rates.update(data["rub"])
+            self._snapshot = _make_snapshot(data["date"], data["ts"], rates)
+            # Запоминается только после разбора: недописанный файл будет перечитан
+            self._mtime = mtime
+            logger.info("Загружены курсы за %s: %s", data['date'], data['rub'])
+        except FileNotFoundError:
+            logger.info("Файл курсов не найден, используются курсы по умолчанию")
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Ошибка при загрузке файла курсов: %s", e)
+        return self._snapshot.is_fresh()
+
+    def reload_if_changed(self) -> bool:
+        """
+        Перечитывает файл, если он изменился после последней загрузки; проверка — один stat.
+
+        Returns:
+            True, если файл перечитан.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self.load()
+        return True
+
+    def save(self, snapshot: RateSnapshot):
+        data = {"v": FORMAT_VERSION, "date": snapshot.date, "ts": snapshot.fetched_at,
+                "rub": {c: snapshot.rates[c] for c in self.currencies}}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".rates-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            os.unlink(tmp_path)
+            # Файл, смонтированный в контейнер отдельно (docker-compose), нельзя
+            # подменить переименованием (EBUSY) — пишем поверх. Читатель, попавший
+            # на недописанный файл, оставит прежний снимок (см. load)
+            logger.warning("Не удалось атомарно заменить %s (%s), запись на место", self.path, e)
+            with open(self.path, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+
+    def _parse(self, data: Dict) -> RateSnapshot:
+        """Строит снимок из ответа API (курсы в нём относительно USD)."""
+        if data.get('result') != 'success':
+            raise ValueError("Ошибка в данных API")
+        api_rates = data['rates']
+        rub_per_usd = api_rates['RUB']
+        rates = {"RUB": 1.0}
+        for currency in self.currencies:
+            if currency in api_rates:
+                rates[currency] = rub_per_usd / api_rates[currency]
+            else:
+                logger.error("Нет курса %s в данных API, оставлен предыдущий", currency)
+                rates[currency] = self._snapshot.rates[currency]
+        return _make_snapshot(str(date.today()), time.time(), rates)
+
+    async def refresh(self, session: Optional[aiohttp.ClientSession] = None) -> RateSnapshot:
+        """
+        Запрашивает все курсы одним запросом, сохраняет и атомарно подменяет снимок.
+        При ошибке поднимает исключение, текущий снимок остаётся прежним.
+        """
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        own_session = session is None
+        if own_session:
+            session = aiohttp.ClientSession(timeout=timeout)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            async with session.get(self.api_url, timeout=timeout) as response:
+                if 400 <= response.status < 500 and response.status != 429:
+                    outcome = "client_error"
+                    raise ClientRequestError(f"Ошибка API: статус {response.status}")
+                if response.status != 200:
+                    outcome = "http_error"
+                    raise RuntimeError(f"Ошибка API: статус {response.status}")
+                snapshot = self._parse(await response.json(content_type=None))
+                outcome = "ok"
+        finally:
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, service="rates", outcome=outcome)
+            if own_session:
+                await session.close()
+        try:
+            self.save(snapshot)
+        except OSError as e:
+            logger.error("Ошибка при сохранении курсов: %s", e)
+        self._snapshot = snapshot
+        logger.info("Обновлены курсы к RUB: %s", dict(snapshot.rates))
+        return snapshot
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+from metrics import UPSTREAM_LATENCY
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+# Числовое значение состояния для метрик
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+# Минимум успешных замеров, после которого задержка хеджирования берётся из p95
+HEDGE_MIN_SAMPLES = 20
+
+
+def _env(service: str, name: str, default: float) -> float:
+    """Параметр сервиса из окружения: <SERVICE>_<NAME>, например CALCUS_RETRIES."""
+    return float(os.getenv(f"{service.upper()}_{name}", str(default)))
+
+
+class UpstreamError(Exception):
+    """Внешний API не вернул результат."""
+
+
+class ClientRequestError(UpstreamError):
+    """Внешний API отклонил сам запрос (4xx, кроме 429): повтор не поможет, а сервис исправен."""
+
+
+class CircuitOpenError(UpstreamError):
+    """Запрос не отправлен: предохранитель разомкнут после серии ошибок."""
+
+
+class SaturatedError(Exception):
+    """Запрос не отправлен: все слоты клиента заняты. Сервис тут ни при чём, повтор только добавит очередь."""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после failure_threshold ошибок подряд размыкается и reset_timeout
+    секунд сразу отклоняет запросы. Затем пропускает один пробный запрос: успех
+    замыкает его, ошибка снова размыкает.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened_total = 0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def cancel_probe(self):
+        """Пробный запрос отменён, не дождавшись ответа: следующий запрос снова может стать пробным."""
+        self._probe_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != CLOSED:
+            logger.info("Предохранитель замкнут: внешний API снова отвечает")
+        self.state = CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.opened_total += 1
+            logger.warning("Предохранитель разомкнут после %s ошибок подряд на %.0f с",
+                           self.failures, self.reset_timeout)
+
+
+class Resilience:
+    """
+    Общая для внешних API политика вызова: повторы с экспоненциальной задержкой и
+    случайным разбросом, предохранитель и (по желанию) хеджирование — второй такой же
+    запрос, если первый не ответил за время p95 успешных ответов сервиса.
+
+    Вызов считается неудачным, если функция бросила исключение или вернула None.
+    ClientRequestError и SaturatedError не повторяются и не считаются ошибкой сервиса
+    для предохранителя.
+    Повторы не выходят за общий бюджет времени budget.
+    """
+
+    def __init__(self, service: str, attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0,
+                 budget: float = 10.0, breaker: Optional[CircuitBreaker] = None, hedge: bool = False,
+                 hedge_min_delay: float = 0.05):
+        self.service = service
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.calls = 0
+        self.retries = 0
+        self.rejected = 0
+        self.failed = 0
+        self.client_errors = 0
+        self.saturated = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_env(cls, service: str, **defaults) -> "Resilience":
+        """
+        Политика с параметрами из окружения <SERVICE>_RETRIES, _BACKOFF_BASE, _BACKOFF_MAX,
+        _RETRY_BUDGET, _BREAKER_FAILURES, _BREAKER_RESET и _HEDGE (1 — включено).
+        """
+        breaker = CircuitBreaker(int(_env(service, "BREAKER_FAILURES", defaults.pop("failure_threshold", 5))),
+                                 _env(service, "BREAKER_RESET", defaults.pop("reset_timeout", 30)))
+        return cls(service,
+                   attempts=int(_env(service, "RETRIES", defaults.get("attempts", 3))),
+                   base_delay=_env(service, "BACKOFF_BASE", defaults.get("base_delay", 0.2)),
+                   max_delay=_env(service, "BACKOFF_MAX", defaults.get("max_delay", 2.0)),
+                   budget=_env(service, "RETRY_BUDGET", defaults.get("budget", 10.0)),
+                   breaker=breaker,
+                   hedge=bool(_env(service, "HEDGE", int(defaults.get("hedge", False)))))
+
+    def retry_delay(self, attempt: int) -> float:
+        """Задержка перед повтором: случайная в пределах экспоненциально растущего окна."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def hedge_delay(self) -> Optional[float]:
+        """Через сколько отправлять второй запрос (p95 успешных ответов); None — пока мало данных."""
+        summary = UPSTREAM_LATENCY.summary().get((self.service, "ok"))
+        if not summary or summary["count"] < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.hedge_min_delay, summary["p95"])
+
+    async def _attempt(self, fn: Callable[[], Awaitable[T]]) -> T:
+        result = await fn()
+        if result is None:
+            raise UpstreamError(f"{self.service}: пустой ответ")
+        return result
+
+    async def _hedged(self, fn: Callable[[], Awaitable[T]], hedge_fn: Callable[[], Awaitable[T]]) -> T:
+        delay = self.hedge_delay() if self.hedge else None
+        first = asyncio.ensure_future(self._attempt(fn))
+        second = None
+        try:
+            if delay is None:
+                return await first
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if done:
+                return first.result()
+            self.hedges += 1
+            second = asyncio.ensure_future(self._attempt(hedge_fn))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            return first.result()
+        finally:
+            for task in (first, second):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    async def call(self, fn: Callable[[], Awaitable[T]],
+                   hedge_fn: Optional[Callable[[], Awaitable[T]]] = None) -> T:
+        """
+        Вызывает fn с повторами; хеджирующий запрос делается через hedge_fn (по умолчанию fn).
+
+        Raises:
+            CircuitOpenError: Если предохранитель разомкнут.
+            ClientRequestError: Если сервис отклонил запрос; без повторов.
+            SaturatedError: Если запрос не дождался свободного слота; без повторов.
+            Exception: Ошибка последней попытки (UpstreamError, если fn вернула None).
+        """
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise CircuitOpenError(f"{self.service}: предохранитель разомкнут")
+        self.calls += 1
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.budget
+        attempt = 0
+        while True:
+            try:
+                result = await self._hedged(fn, hedge_fn or fn)
+                self.breaker.record_success()
+                return result
+            except asyncio.CancelledError:
+                self.breaker.cancel_probe()
+                raise
+            except ClientRequestError:
+                # Сервис ответил — для предохранителя это не сбой
+                self.breaker.record_success()
+                self.client_errors += 1
+                raise
+            except SaturatedError:
+                # Запрос не дошёл до сервиса: о его состоянии ничего не известно
+                self.breaker.cancel_probe()
+                self.saturated += 1
+                raise
+            except Exception as e:
+                self.breaker.record_failure()
+                attempt += 1
+                delay = self.retry_delay(attempt - 1)
+                if attempt >= self.attempts or loop.time() + delay >= deadline or not self.breaker.allow():
+                    self.failed += 1
+                    raise
+                logger.warning("%s: попытка %s не удалась (%s), повтор через %.2f с",
+                               self.service, attempt, e, delay)
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    def stats(self) -> Dict:
+        return {
+            "state": STATE_CODES[self.breaker.state],
+            "consecutive_failures": self.breaker.failures,
+            "opened_total": self.breaker.opened_total,
+            "calls": self.calls,
+            "retries": self.retries,
+            "failed": self.failed,
+            "client_errors": self.client_errors,
+            "saturated": self.saturated,
+            "rejected": self.rejected,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+class ResilientCalcusClient:
+    """
+    Обёртка над клиентом calcus.ru с повторами, предохранителем и хеджированием.
+    Каждая попытка ограничена attempt_timeout (ожидание слота клиента в него не входит);
+    при разомкнутом предохранителе или занятых слотах сразу возвращает None, и ответ
+    берут верхние слои (устаревший кэш, локальный расчёт). Хеджирующий запрос слота
+    не ждёт: если свободного нет, второй запрос только удлинил бы очередь.
+    """
+
+    def __init__(self, client, resilience: Optional[Resilience] = None, attempt_timeout: Optional[float] = None):
+        self.client = client
+        self.resilience = resilience or Resilience.from_env("calcus", attempts=3, budget=10.0, hedge=True)
+        self.attempt_timeout = attempt_timeout or _env("calcus", "ATTEMPT_TIMEOUT", 4.0)
+
+    async def calculate_customs(self, params: Dict, **kwargs) -> Optional[Dict]:
+        kwargs.setdefault("timeout", self.attempt_timeout)
+        hedge_kwargs = dict(kwargs, queue_timeout=0)
+        try:
+            return await self.resilience.call(lambda: self.client.calculate_customs(params, **kwargs),
+                                              lambda: self.client.calculate_customs(params, **hedge_kwargs))
+        except (CircuitOpenError, ClientRequestError):
+            return None
+        except SaturatedError as e:
+            logger.warning("%s", e)
+            return None
+        except Exception as e:
+            logger.error("calcus.ru не ответил после повторов: %s", e)
+            return None
+
+    def stats(self) -> Dict:
+        return self.resilience.stats()
+
+    async def close(self):
+        await self.client.close()
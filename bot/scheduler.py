@@ -0,0 +1,221 @@
+import asyncio
+import inspect
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Поток для блокирующего ввода-вывода задач (SQLite, файлы). Один на процесс: записи
+# разных хранилищ идут по очереди и не конкурируют за диск
+_io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scheduler-io")
+
+
+async def run_blocking(func: Callable, *args) -> Any:
+    """Выполняет блокирующую функцию в потоке ввода-вывода, не задерживая цикл событий."""
+    return await asyncio.get_event_loop().run_in_executor(_io_executor, func, *args)
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> Set[int]:
+    """Разбирает поле cron-выражения: *, */n, a-b, a-b/n и списки через запятую."""
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/')
+            step = int(step_text)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-')
+            start, end = int(start_text), int(end_text)
+        else:
+            start = end = int(part)
+        if start < low or end > high or start > end:
+            raise ValueError(f"Недопустимое значение cron-поля: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """
+    Расписание в формате cron из пяти полей: минута, час, день месяца, месяц, день недели
+    (0 — воскресенье). Время локальное. Как в стандартном cron, если ограничены оба поля
+    дня (ни одно не начинается с *), достаточно совпадения любого из них:
+    "0 9 1 * 1" — 1-го числа и по понедельникам.
+    """
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Ожидалось 5 полей cron-выражения: {expression}")
+        self.expression = expression
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {d % 7 for d in _parse_cron_field(fields[4], 0, 7)}
+        self._any_day = fields[2].startswith('*') or fields[4].startswith('*')
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = moment.isoweekday() % 7 in self.weekdays
+        return day and weekday if self._any_day else day or weekday
+
+    def next_after(self, moment: datetime) -> datetime:
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Поиск ограничен пятью годами (29 февраля бывает раз в четыре): выражения
+        # без совпадений отвергаются. Неподходящие дни и часы пропускаются целиком
+        limit = candidate + timedelta(days=5 * 366)
+        while candidate < limit:
+            if candidate.month not in self.months or not self._day_matches(candidate):
+                candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+            elif candidate.hour not in self.hours:
+                candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron-выражение никогда не срабатывает: {self.expression}")
+
+
+class Job:
+    """Задача планировщика вместе с её метриками выполнения."""
+
+    def __init__(self, name: str, func: Callable, interval: Optional[float] = None,
+                 cron: Optional[str] = None, jitter: float = 0, retries: int = 0,
+                 backoff: float = 5, run_at_start: bool = False):
+        if (interval is None) == (cron is None):
+            raise ValueError("Нужно указать ровно один из параметров interval или cron")
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.cron = CronSchedule(cron) if cron else None
+        if self.cron is not None:
+            # Выражение без срабатываний (например, 31 февраля) отвергается при регистрации,
+            # а не падает позже в фоновой задаче
+            self.cron.next_after(datetime.now())
+        self.jitter = jitter
+        self.retries = retries
+        self.backoff = backoff
+        self.run_at_start = run_at_start
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_duration: Optional[float] = None
+        self.total_duration = 0.0
+        self.last_run: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    def next_delay(self) -> float:
+        """Секунды до следующего запуска с учётом случайного сдвига."""
+        if self.cron is not None:
+            now = datetime.now()
+            delay = (self.cron.next_after(now) - now).total_seconds()
+        else:
+            delay = self.interval
+        return delay + random.uniform(0, self.jitter)
+
+    def stats(self) -> Dict:
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "running": self.running,
+            "last_duration": self.last_duration,
+            "avg_duration": self.total_duration / self.runs if self.runs else None,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "last_error": self.last_error
+        }
+
+
+class AsyncScheduler:
+    """
+    Планировщик периодических задач на цикле событий aiogram.
+
+    Корутины выполняются прямо в цикле; синхронные функции тоже вызываются в цикле,
+    поэтому должны быть короткими и работать только с памятью. Задача с записью на
+    диск — корутина, которая готовит данные в цикле и пишет их через run_blocking().
+    Задача не запускается повторно, пока не завершился предыдущий запуск. Неудачный
+    запуск повторяется до retries раз с экспоненциальной задержкой backoff * 2^n.
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def add_job(self, name: str, func: Callable, **kwargs) -> Job:
+        job = Job(name, func, **kwargs)
+        self.jobs[name] = job
+        return job
+
+    def every(self, seconds: float, name: str, func: Callable, **kwargs) -> Job:
+        return self.add_job(name, func, interval=seconds, **kwargs)
+
+    def cron(self, expression: str, name: str, func: Callable, **kwargs) -> Job:
+        return self.add_job(name, func, cron=expression, **kwargs)
+
+    async def _execute(self, job: Job):
+        if job.running:
+            job.skipped += 1
+            logger.warning("Задача %s ещё выполняется, запуск пропущен", job.name)
+            return
+        job.running = True
+        started = time.monotonic()
+        job.last_run = datetime.now()
+        try:
+            for attempt in range(job.retries + 1):
+                try:
+                    result = job.func()
+                    if inspect.isawaitable(result):
+                        await result
+                    job.last_error = None
+                    break
+                except Exception as e:
+                    job.failures += 1
+                    job.last_error = str(e)
+                    if attempt == job.retries:
+                        logger.error("Задача %s завершилась ошибкой: %s", job.name, e)
+                        break
+                    delay = job.backoff * 2 ** attempt
+                    logger.warning("Задача %s завершилась ошибкой: %s, повтор через %.0f с", job.name, e, delay)
+                    await asyncio.sleep(delay)
+        finally:
+            job.running = False
+            job.runs += 1
+            job.last_duration = time.monotonic() - started
+            job.total_duration += job.last_duration
+
+    async def _loop(self, job: Job):
+        if job.run_at_start:
+            asyncio.ensure_future(self._execute(job))
+        while True:
+            await asyncio.sleep(job.next_delay())
+            # Запуск в отдельной задаче, чтобы долгий запуск не сдвигал расписание
+            asyncio.ensure_future(self._execute(job))
+
+    async def run_now(self, name: str):
+        await self._execute(self.jobs[name])
+
+    def start(self):
+        """Запускает все зарегистрированные задачи в текущем цикле событий."""
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.ensure_future(self._loop(job)))
+        logger.info("Планировщик запущен, задач: %s", len(self.jobs))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self) -> Dict[str, Dict]:
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+
+# Общий планировщик процесса
+scheduler = AsyncScheduler()
@@ -0,0 +1,221 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Set
+from aiogram import Bot, types
+from aiogram.utils.exceptions import RetryAfter
+from metrics import SEND_LATENCY, SEND_RESULTS
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит отправки (Telegram допускает около 30 сообщений в секунду), 0 — без ограничения
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+# Лимит на один чат: сообщений в секунду и допустимый всплеск
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+# Число параллельных отправителей
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+# Сколько ждать отправки оставшихся сообщений при остановке, секунды
+SEND_DRAIN_TIMEOUT = float(os.getenv("SEND_DRAIN_TIMEOUT", "10"))
+# Сколько ограничителей чатов держать в памяти
+SEND_MAX_CHAT_BUCKETS = 10000
+
+# Приоритеты: меньше — раньше
+HIGH, NORMAL, LOW = 0, 1, 2
+
+
+class OutboundMessage:
+    __slots__ = ("method", "kwargs", "priority", "created", "future")
+
+    def __init__(self, method: str, kwargs: Dict, priority: int, future: asyncio.Future):
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.created = time.perf_counter()
+        self.future = future
+
+
+def _retrieve_exception(future: asyncio.Future):
+    # Ошибку доставки уже залогировал отправитель; хендлер может не ждать результат
+    if not future.cancelled():
+        future.exception()
+
+
+class SendQueue:
+    """
+    Очередь исходящих сообщений в Telegram.
+
+    Хендлеры ставят сообщение в очередь и сразу возвращаются; несколько отправителей
+    доставляют сообщения с общим ограничением частоты и ограничением на чат. Сообщения
+    одного чата уходят строго по порядку (в полёте не больше одного на чат), между
+    чатами первым обслуживается чат с более приоритетным сообщением в голове очереди.
+    При RetryAfter сообщение остаётся в голове очереди чата, а отправка приостанавливается
+    на указанное Telegram время.
+    """
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 chat_burst: float = SEND_CHAT_BURST, workers: int = SEND_WORKERS):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.bot: Optional[Bot] = None
+        self._chats: Dict[int, Deque[OutboundMessage]] = {}
+        self._active: Set[int] = set()
+        self._ready: List = []
+        self._seq = itertools.count()
+        self._buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._global = TokenBucket(global_rate)
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+
+    def start(self, bot: Bot, global_rate: Optional[float] = None):
+        """Запускает отправителей; global_rate задаёт долю общего лимита этого процесса."""
+        self.bot = bot
+        if global_rate is not None:
+            self._global = TokenBucket(global_rate)
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        if self._ready:
+            self._wakeup.set()
+        self._update_idle()
+        self._tasks = [asyncio.ensure_future(self._sender()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = SEND_DRAIN_TIMEOUT):
+        """Дожидается отправки оставшихся сообщений (не дольше timeout) и останавливает отправителей."""
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не отправлено сообщений при остановке: %s", self.depth())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def drain(self):
+        if self._idle is not None:
+            await self._idle.wait()
+
+    def depth(self) -> int:
+        return sum(len(messages) for messages in self._chats.values())
+
+    def submit(self, chat_id: int, method: str, priority: int = NORMAL, **kwargs) -> asyncio.Future:
+        """
+        Ставит вызов метода Bot API (send_message, send_document, edit_message_text...) в очередь чата.
+
+        Returns:
+            Future с результатом вызова; ждать его не обязательно.
+        """
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(_retrieve_exception)
+        self._chats.setdefault(chat_id, deque()).append(OutboundMessage(method, kwargs, priority, future))
+        if chat_id not in self._active:
+            self._active.add(chat_id)
+            self._push(chat_id)
+        self._update_idle()
+        return future
+
+    def answer(self, message: types.Message, text: str, priority: int = NORMAL, **kwargs) -> asyncio.Future:
+        """Ответ в чат сообщения — замена message.answer, не дожидающаяся отправки."""
+        return self.submit(message.chat.id, "send_message", priority, text=text, **kwargs)
+
+    def _push(self, chat_id: int):
+        messages = self._chats.get(chat_id)
+        if not messages:
+            self._chats.pop(chat_id, None)
+            self._active.discard(chat_id)
+            self._update_idle()
+            return
+        heapq.heappush(self._ready, (messages[0].priority, next(self._seq), chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _update_idle(self):
+        if self._idle is None:
+            return
+        if self._active:
+            self._idle.clear()
+        else:
+            self._idle.set()
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._buckets) > SEND_MAX_CHAT_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _next_chat(self) -> int:
+        while not self._ready:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return heapq.heappop(self._ready)[2]
+
+    async def _sender(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            chat_id = await self._next_chat()
+            wait = self._bucket(chat_id).try_acquire()
+            if wait:
+                # Чат исчерпал свой лимит: вернётся в очередь, когда появится токен
+                loop.call_later(wait, self._push, chat_id)
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._global.acquire()
+            await self._send(chat_id)
+
+    async def _send(self, chat_id: int):
+        message = self._chats[chat_id][0]
+        try:
+            result = await getattr(self.bot, message.method)(chat_id=chat_id, **message.kwargs)
+        except RetryAfter as e:
+            self.retry_after += 1
+            SEND_RESULTS.inc(outcome="retry_after")
+            self._paused_until = max(self._paused_until, time.monotonic() + e.timeout)
+            logger.warning("Telegram просит подождать %s с, отправка приостановлена", e.timeout)
+            asyncio.get_event_loop().call_later(e.timeout, self._push, chat_id)
+            return
+        except Exception as e:
+            self.failed += 1
+            SEND_RESULTS.inc(outcome="error")
+            logger.error("Не удалось отправить сообщение в чат %s: %s", chat_id, e)
+            self._chats[chat_id].popleft()
+            if not message.future.done():
+                message.future.set_exception(e)
+        else:
+            self.sent += 1
+            SEND_RESULTS.inc(outcome="ok")
+            SEND_LATENCY.observe(time.perf_counter() - message.created, method=message.method)
+            self._chats[chat_id].popleft()
+            if not message.future.done():
+                message.future.set_result(result)
+        self._push(chat_id)
+
+    def stats(self) -> Dict:
+        return {
+            "depth": self.depth(),
+            "chats": len(self._active),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "paused": max(0.0, self._paused_until - time.monotonic()),
+        }
+
+
+# Общая очередь процесса; отправители запускаются в on_startup
+outbox = SendQueue()
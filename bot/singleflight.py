@@ -0,0 +1,54 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+from api_client import params_key
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные вызовы с одинаковым ключом в одно выполнение.
+
+    Первый вызов запускает задачу, остальные ждут её же результата. Исключение
+    задачи получает каждый ожидающий. Отмена одного из ожидающих не отменяет
+    общую задачу для остальных.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.calls = 0
+        self.executions = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.calls - self.executions,
+            "in_flight": len(self._inflight),
+            "fan_in": self.calls / self.executions if self.executions else 0.0
+        }
+
+
+class CoalescingCalcusClient:
+    """Обёртка над клиентом calcus.ru: одинаковые одновременные запросы уходят в API один раз."""
+
+    def __init__(self, client, group: Optional[SingleFlight] = None):
+        self.client = client
+        self.group = group or SingleFlight()
+
+    async def calculate_customs(self, params: Dict, **kwargs) -> Optional[Dict]:
+        return await self.group.do(params_key(params), lambda: self.client.calculate_customs(params, **kwargs))
+
+    def stats(self) -> Dict:
+        return self.group.stats()
+
+    async def close(self):
+        await self.client.close()
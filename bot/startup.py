@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Момент запуска процесса: модуль импортируется первым в bot.py
+PROCESS_STARTED = time.perf_counter()
+
+
+class Warmup:
+    """
+    Шаги запуска бота.
+
+    Импорт модулей не ходит ни в сеть, ни на диск: всё, что нужно прочитать или
+    загрузить, регистрируется здесь шагом. Шаги с background=False выполняются в
+    start() до приёма обновлений (чтение локальных снимков), остальные — в фоне,
+    пока бот уже отвечает по устаревшему снимку. Когда фоновые шаги закончены,
+    процесс считается готовым (is_ready, /ready). Ошибка шага логируется и не
+    мешает запуску.
+    """
+
+    def __init__(self):
+        self._steps: List[Tuple[str, Callable, bool]] = []
+        self._durations: Dict[str, float] = {}
+        self._ready: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.startup_seconds: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self.failed = 0
+
+    def add(self, name: str, func: Callable, background: bool = True):
+        """
+        Регистрирует шаг; func — обычная функция или корутинная функция без аргументов.
+        Обычная функция выполняется прямо в цикле событий, поэтому фоновые шаги, читающие
+        диск или базу, — корутины, уводящие эту работу в поток (run_blocking).
+        """
+        self._steps.append((name, func, background))
+
+    async def _run(self, name: str, func: Callable):
+        started = time.perf_counter()
+        try:
+            result = func()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            self.failed += 1
+            logger.error("Шаг запуска %s завершился ошибкой: %s", name, e)
+        self._durations[name] = time.perf_counter() - started
+
+    async def start(self):
+        """Выполняет шаги до приёма обновлений и запускает фоновые."""
+        self._ready = asyncio.Event()
+        for name, func, background in self._steps:
+            if not background:
+                await self._run(name, func)
+        self.startup_seconds = time.perf_counter() - PROCESS_STARTED
+        logger.info("Бот запущен за %.2f с", self.startup_seconds)
+        self._task = asyncio.ensure_future(self._background())
+
+    async def _background(self):
+        for name, func, background in self._steps:
+            if background:
+                await self._run(name, func)
+        self.warmup_seconds = time.perf_counter() - PROCESS_STARTED
+        self._ready.set()
+        logger.info("Прогрев завершён за %.2f с после запуска процесса", self.warmup_seconds)
+
+    def is_ready(self) -> bool:
+        return self._ready is not None and self._ready.is_set()
+
+    async def wait_ready(self):
+        if self._ready is None:
+            await self.start()
+        await self._ready.wait()
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> Dict:
+        stats = {
+            "ready": int(self.is_ready()),
+            "startup_seconds": self.startup_seconds or 0.0,
+            "warmup_seconds": self.warmup_seconds or 0.0,
+            "failed_steps": self.failed,
+        }
+        for name, duration in self._durations.items():
+            stats[f"step_{name}_seconds"] = duration
+        return stats
+
+
+# Шаги запуска процесса; выполняются в on_startup
+warmup = Warmup()
@@ -0,0 +1,182 @@
+"""
+Запись входящего трафика и ответов внешних API для воспроизведения (bench/replay.py).
+
+В файл JSONL пишутся события с временем time.time():
+    {"t": ..., "kind": "update", "user": <корзина>, "text": "<обезличенный текст>"}
+    {"t": ..., "kind": "calcus", "params": {...}, "result": {...}, "latency": 0.31}
+    {"t": ..., "kind": "rates", "rub": {"USD": 80.0, ...}}
+
+Вместо id пользователя пишется его корзина — HMAC от id с секретом записи, поэтому
+разные пользователи остаются разными, но исходный id не восстановить. В тексте
+сохраняются только токены, которые разбирает бот: команды, слова из кнопок и словарей
+быстрого расчёта, одно число (ответ на шаг диалога) и числа быстрого расчёта, если он
+разобран без ошибок. Остальное заменяется символами x той же длины. Записываются
+пользователи из доли TRAFFIC_RECORD_SAMPLE корзин целиком, чтобы диалоги не рвались.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+from typing import Dict, List, Optional
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from batch_writer import BatchWriter
+from convector import rate_store
+from pricing import REGIONS, AGES, ENGINE_TYPES
+from quick_quote import (REGION_ALIASES, AGE_ALIASES, ENGINE_ALIASES, QUICK_QUOTE_PATTERN,
+                         parse_quick_quote)
+
+logger = logging.getLogger(__name__)
+
+# Файл записи (пусто — не записывать); воркеры webhook-режима пишут в <имя>.<номер>.jsonl
+TRAFFIC_RECORD_FILE = os.getenv("TRAFFIC_RECORD_FILE", "")
+# Доля записываемых пользователей, от 0 до 1
+TRAFFIC_RECORD_SAMPLE = float(os.getenv("TRAFFIC_RECORD_SAMPLE", "1"))
+# Число корзин, по которым раскладываются id пользователей
+TRAFFIC_USER_BUCKETS = int(os.getenv("TRAFFIC_USER_BUCKETS", "1000000"))
+# Секрет для корзин; без него он генерируется заново при каждом запуске
+TRAFFIC_RECORD_SECRET = os.getenv("TRAFFIC_RECORD_SECRET", "")
+# Как часто записанные события сбрасываются в файл, секунды
+TRAFFIC_FLUSH_INTERVAL = float(os.getenv("TRAFFIC_FLUSH_INTERVAL", "5"))
+
+# Слова, которые бот понимает и которые можно сохранить в записи
+VOCABULARY = ({word.lower() for label in (*REGIONS, *AGES, *ENGINE_TYPES) for word in label.split()}
+              | set(REGION_ALIASES) | set(AGE_ALIASES) | set(ENGINE_ALIASES))
+_COMMAND_RE = re.compile(r"^/\w+(@\w+)?$")
+# Число, которое бот принимает в ответ на шаг диалога; длинные числа не сохраняются
+_NUMBER_RE = re.compile(r"^\d{1,10}(\.\d+)?$")
+_QUICK_QUOTE_RE = re.compile(QUICK_QUOTE_PATTERN)
+
+
+def _is_quick_quote(text: str) -> bool:
+    try:
+        parse_quick_quote(text)
+    except ValueError:
+        return False
+    return True
+
+
+def anonymize_text(text: str) -> str:
+    """
+    Оставляет команды и известные боту слова; числа — только если это ответ на шаг
+    диалога или аргумент команды (одно число) или быстрый расчёт, который бот разберёт.
+    Остальное заменяется на xxx, так что номера карт и телефонов, записанные через
+    пробелы, не сохраняются.
+    """
+    tokens = text.split()
+    command = tokens[0] if tokens and _COMMAND_RE.match(tokens[0]) else None
+    body = tokens[1:] if command else tokens
+    if command == "/calc" or (command is None and _QUICK_QUOTE_RE.match(text)):
+        keep_numbers = _is_quick_quote(" ".join(body))
+    else:
+        # Один аргумент: ответ на шаг диалога или параметр команды (/quotes 7)
+        keep_numbers = len(body) == 1
+    kept = [command] if command else []
+    for token in body:
+        if token.lower() in VOCABULARY or (keep_numbers and _NUMBER_RE.match(token)):
+            kept.append(token)
+        else:
+            kept.append("x" * len(token))
+    return " ".join(kept)
+
+
+def record_path(path: str, shard=None) -> str:
+    if not shard:
+        return path
+    base, extension = os.path.splitext(path)
+    return f"{base}.{shard[0]}{extension or '.jsonl'}"
+
+
+class TrafficRecorder(BatchWriter):
+    """Буферизованная запись событий в JSONL-файл; при ошибке записи пачка теряется."""
+
+    def __init__(self, path: str, sample: float = TRAFFIC_RECORD_SAMPLE,
+                 buckets: int = TRAFFIC_USER_BUCKETS, secret: str = TRAFFIC_RECORD_SECRET):
+        self.path = path
+        self.sample = sample
+        self.buckets = buckets
+        self._secret = (secret or os.urandom(16).hex()).encode()
+        self._events: List[str] = []
+        self._rates: Optional[Dict] = None
+        self.recorded = 0
+
+    def user_bucket(self, user_id: int) -> int:
+        digest = hmac.new(self._secret, str(user_id).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], "big") % self.buckets
+
+    def sampled(self, bucket: int) -> bool:
+        return bucket < self.sample * self.buckets
+
+    def _add(self, kind: str, **fields):
+        fields["t"] = time.time()
+        fields["kind"] = kind
+        self._events.append(json.dumps(fields, ensure_ascii=False))
+        self.recorded += 1
+
+    def record_update(self, user_id: int, text: str):
+        bucket = self.user_bucket(user_id)
+        if self.sampled(bucket):
+            self._check_rates()
+            self._add("update", user=bucket, text=anonymize_text(text))
+
+    def record_calcus(self, api_params: Dict, result: Optional[Dict], latency: float):
+        """Ответ calcus.ru на запрос с параметрами API и время самого HTTP-запроса."""
+        self._add("calcus", params=api_params, result=result, latency=latency)
+
+    def _check_rates(self):
+        # Курсы записываются при первом событии и после каждого обновления
+        rates = dict(rate_store.current().rates)
+        if rates != self._rates:
+            self._rates = rates
+            self._add("rates", rub=rates)
+
+    def _pending(self) -> bool:
+        return bool(self._events)
+
+    def _take(self) -> List[str]:
+        events, self._events = self._events, []
+        return events
+
+    def _write(self, events: List[str]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(events) + "\n")
+
+    def _write_failed(self, events: List[str], error: OSError):
+        logger.error("Ошибка записи трафика в %s: %s", self.path, error)
+
+    def stats(self) -> Dict:
+        return {"recorded": self.recorded, "buffered": len(self._events)}
+
+    def close(self):
+        self.flush()
+
+
+class TrafficRecorderMiddleware(BaseMiddleware):
+    """Записывает текст входящих сообщений; сообщения без текста (файлы) не записываются."""
+
+    def __init__(self, recorder: TrafficRecorder):
+        super().__init__()
+        self.recorder = recorder
+
+    async def on_pre_process_message(self, message, data: dict):
+        if message.text and message.from_user:
+            self.recorder.record_update(message.from_user.id, message.text)
+
+
+# Запись процесса; создаётся в create_dispatcher, если задан TRAFFIC_RECORD_FILE
+recorder: Optional[TrafficRecorder] = None
+
+
+def create_recorder(shard=None) -> Optional[TrafficRecorder]:
+    global recorder
+    if TRAFFIC_RECORD_FILE and recorder is None:
+        recorder = TrafficRecorder(record_path(TRAFFIC_RECORD_FILE, shard))
+        logger.info("Запись трафика в %s, доля пользователей %s", recorder.path, recorder.sample)
+    return recorder
+
+
+def schedule_recorder_tasks(scheduler):
+    if recorder is not None:
+        scheduler.every(TRAFFIC_FLUSH_INTERVAL, "flush_traffic_record", recorder.flush_in_background)
@@ -1,49 +1,168 @@
+import asyncio
 import sqlite3
 import logging
+import os
 from datetime import datetime, date
-import schedule
-import time
-import threading
+from typing import Dict, List, Optional, Set, Tuple
+from batch_writer import SQLiteBatchWriter
+from metrics import SQLITE_LATENCY
+from scheduler import run_blocking
 
-logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 logger = logging.getLogger(__name__)
 
 # Максимальное количество расчётов в день
 MAX_ATTEMPTS = 3
 # Путь к базе данных SQLite
 DB_FILE = "usage_data.db"
+# Расписание очистки устаревших данных (cron: минута час день месяц день_недели)
+CLEANUP_CRON = os.getenv("USAGE_CLEANUP_CRON", "0 9 * * *")
+# Как часто счётчики сбрасываются на диск, секунды (окно возможной потери при сбое)
+FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
 
 
-def init_db():
-    """Инициализирует базу данных и создаёт таблицу, если она не существует."""
+class UsageLimiter(SQLiteBatchWriter):
+    """
+    Дневной лимит расчётов на пользователя.
+
+    Счётчики за текущий день хранятся в памяти; проверка и увеличение выполняются
+    без await, поэтому атомарны в цикле событий. Изменённые счётчики пачкой
+    записываются в SQLite в режиме WAL (см. SQLiteBatchWriter). При старте
+    счётчики за сегодня восстанавливаются из базы.
+    """
+
+    flush_operation = "usage_flush"
+
+    def __init__(self, db_file: str = DB_FILE, max_attempts: int = MAX_ATTEMPTS):
+        super().__init__()
+        self.db_file = db_file
+        self.max_attempts = max_attempts
+        self._day = str(date.today())
+        self._counts: Dict[int, int] = {}
+        self._dirty: Set[int] = set()
+        # Запись счётчиков прошлого дня, начатая при смене дня
+        self._roll_write: Optional[asyncio.Future] = None
+
+    def _connect(self, day: str) -> Tuple[sqlite3.Connection, List[Tuple[int, int]]]:
+        """Открывает соединение, создаёт таблицу и читает счётчики дня (в потоке ввода-вывода)."""
+        conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                user_id INTEGER,
+                date TEXT,
+                attempts INTEGER,
+                PRIMARY KEY (user_id, date)
+            )
+        """)
+        # Первичный ключ начинается с user_id, для очистки по дате нужен свой индекс
+        conn.execute("CREATE INDEX IF NOT EXISTS usage_date ON usage (date)")
+        conn.commit()
+        rows = conn.execute("SELECT user_id, attempts FROM usage WHERE date = ?", (day,)).fetchall()
+        return conn, rows
+
+    async def open(self):
+        """
+        Открывает соединение и восстанавливает счётчики за сегодня: чтение базы — в потоке
+        ввода-вывода, счётчики объединяются в цикле. Расчёты, сделанные до открытия базы,
+        прибавляются к восстановленным.
+        """
+        if self._conn is not None:
+            return
+        today = str(date.today())
+        if today != self._day:
+            self._day, self._counts = today, {}
+            self._dirty.clear()
+        with SQLITE_LATENCY.time(operation="usage_load"):
+            self._conn, rows = await run_blocking(self._connect, self._day)
+        for user_id, attempts in rows:
+            self._counts[user_id] = self._counts.get(user_id, 0) + attempts
+        logger.info("Восстановлены счётчики %s пользователей за %s", len(rows), self._day)
+
+    def _roll_day(self, today: str):
+        """
+        При смене дня обнуляет счётчики. Накопленное за прошлый день снимается здесь же,
+        в цикле событий, а записывается в потоке ввода-вывода, не задерживая хендлер.
+        """
+        if self._pending():
+            self._roll_write = asyncio.ensure_future(self._write_in_background(self._take()))
+        self._day = today
+        self._counts = {}
+        # Если база ещё не открыта, счётчики прошлого дня уже не нужны
+        self._dirty.clear()
+
+    def check_and_update(self, user_id: int) -> Tuple[bool, int, str]:
+        today = str(date.today())
+        if today != self._day:
+            self._roll_day(today)
+        attempts = self._counts.get(user_id, 0)
+        if attempts >= self.max_attempts:
+            return False, 0, today
+        attempts += 1
+        self._counts[user_id] = attempts
+        self._dirty.add(user_id)
+        return True, self.max_attempts - attempts, today
+
+    def _pending(self) -> bool:
+        return bool(self._dirty) and self._conn is not None
+
+    def _take(self) -> List[Tuple[int, str, int]]:
+        rows = [(user_id, self._day, self._counts[user_id]) for user_id in self._dirty]
+        self._dirty.clear()
+        return rows
+
+    def _write(self, rows: List[Tuple[int, str, int]]):
+        # MAX защищает от перезаписи большего значения, записанного другим процессом
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT INTO usage (user_id, date, attempts) VALUES (?, ?, ?)
+                ON CONFLICT(user_id, date) DO UPDATE SET attempts = MAX(attempts, excluded.attempts)
+            """, rows)
+
+    def _write_failed(self, rows: List[Tuple[int, str, int]], error: sqlite3.Error):
+        logger.error("Ошибка при сохранении счётчиков: %s", error)
+        # Счётчики прошлого дня после его смены уже не в памяти: они теряются
+        self._dirty.update(user_id for user_id, day, _ in rows if day == self._day)
+
+    def _delete_before(self, day: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM usage WHERE date < ?", (day,))
+
+    async def clean_old(self):
+        """Удаляет записи за предыдущие дни в потоке ввода-вывода."""
+        if self._conn is None:
+            return
+        today = str(date.today())
+        with SQLITE_LATENCY.time(operation="usage_cleanup"):
+            await run_blocking(self._delete_before, today)
+        logger.info("Устаревшие данные за дни до %s удалены", today)
+
+    def stats(self) -> Dict:
+        return {"users_today": len(self._counts), "dirty": len(self._dirty)}
+
+    def close(self):
+        self._close_connection()
+
+
+# Общий лимитер процесса
+limiter = UsageLimiter()
+
+
+async def init_db():
+    """Инициализирует базу данных, создаёт таблицу и загружает счётчики за сегодня."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS usage (
-                    user_id INTEGER,
-                    date TEXT,
-                    attempts INTEGER,
-                    PRIMARY KEY (user_id, date)
-                )
-            """)
-            conn.commit()
-            logger.info("База данных инициализирована")
+        await limiter.open()
+        logger.info("База данных инициализирована")
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при инициализации базы данных: {e}")
+        logger.error("Ошибка при инициализации базы данных: %s", e)
 
 
-def clean_old_usage_data():
+async def clean_old_usage_data():
     """Удаляет записи за предыдущие дни."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            today = str(date.today())
-            cursor.execute("DELETE FROM usage WHERE date != ?", (today,))
-            conn.commit()
-            logger.info(f"Устаревшие данные за дни до {today} удалены")
+        await limiter.clean_old()
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при очистке устаревших данных: {e}")
+        logger.error("Ошибка при очистке устаревших данных: %s", e)
 
 
 def check_and_update_usage(user_id: int):
@@ -51,55 +170,20 @@ def check_and_update_usage(user_id: int):
     Проверяет, может ли пользователь выполнить расчёт, и обновляет счётчик.
     Возвращает кортеж (можно_ли_выполнить, оставшиеся_попытки, дата_сброса).
     """
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            today = str(date.today())
-
-            # Проверяем текущие попытки пользователя
-            cursor.execute(
-                "SELECT attempts FROM usage WHERE user_id = ? AND date = ?",
-                (user_id, today)
-            )
-            result = cursor.fetchone()
-
-            if result is None:
-                # Если записи нет, создаём новую
-                attempts = 0
-                cursor.execute(
-                    "INSERT INTO usage (user_id, date, attempts) VALUES (?, ?, ?)",
-                    (user_id, today, attempts)
-                )
-            else:
-                attempts = result[0]
-
-            if attempts >= MAX_ATTEMPTS:
-                return False, 0, today
-
-            # Увеличиваем счётчик попыток
-            attempts += 1
-            cursor.execute(
-                "UPDATE usage SET attempts = ? WHERE user_id = ? AND date = ?",
-                (attempts, user_id, today)
-            )
-            conn.commit()
+    return limiter.check_and_update(user_id)
 
-            remaining = MAX_ATTEMPTS - attempts
-            return True, remaining, today
 
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при работе с базой данных: {e}")
-        return False, 0, str(date.today())
+async def flush_usage_data():
+    """Сбрасывает накопленные счётчики на диск."""
+    await limiter.flush_in_background()
 
 
-def schedule_cleanup():
+def schedule_cleanup(scheduler):
     """Планирует ежедневную очистку устаревших данных."""
-    schedule.every().day.at("09:00").do(clean_old_usage_data)
-    logger.info("Запланирована ежедневная очистка устаревших данных в 09:00")
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+    scheduler.cron(CLEANUP_CRON, "clean_old_usage_data", clean_old_usage_data)
+    logger.info("Запланирована ежедневная очистка устаревших данных (%s)", CLEANUP_CRON)
 
 
-# Инициализация базы данных при запуске
-init_db()
\ No newline at end of file
+def schedule_flush(scheduler):
+    """Планирует периодическую запись счётчиков на диск."""
+    scheduler.every(FLUSH_INTERVAL, "flush_usage_data", flush_usage_data)
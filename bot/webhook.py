@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+from typing import List, Optional
+from aiohttp import web
+from aiogram import Bot, types, executor
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, на который Telegram отправляет обновления (например, https://example.com)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет, который Telegram передаёт в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Адрес, на котором слушает HTTP-сервер
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# Число процессов, обрабатывающих обновления
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+
+# Разделы обновления, в которых Telegram передаёт автора
+_USER_FIELDS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                "shipping_query", "pre_checkout_query", "my_chat_member", "chat_member", "chat_join_request")
+
+
+def update_user_id(update: dict) -> int:
+    """Возвращает id пользователя, от которого пришло обновление (0, если его нет)."""
+    for field in _USER_FIELDS:
+        payload = update.get(field)
+        if payload and "from" in payload:
+            return payload["from"]["id"]
+    return 0
+
+
+def shard_for(user_id: int, workers: int) -> int:
+    """Номер воркера для пользователя: все обновления одного пользователя идут в один процесс."""
+    return user_id % workers
+
+
+async def _consume(dp, queue: multiprocessing.Queue):
+    """Получает обновления из очереди воркера и передаёт их диспетчеру."""
+    loop = asyncio.get_event_loop()
+    while True:
+        raw = await loop.run_in_executor(None, queue.get)
+        if raw is None:
+            break
+        update = types.Update(**json.loads(raw))
+        asyncio.ensure_future(dp.process_update(update))
+
+
+def _worker_main(index: int, workers: int, queue: multiprocessing.Queue):
+    """Точка входа процесса-воркера: свой цикл событий и диспетчер для своей доли пользователей."""
+    from bot import create_dispatcher, on_startup, on_shutdown
+    from log_setup import setup_logging
+
+    setup_logging()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    dp = create_dispatcher(primary=index == 0, shard=(index, workers))
+    logger.info("Воркер %s/%s запущен (pid %s)", index, workers, os.getpid())
+    executor.start(dp, _consume(dp, queue), on_startup=on_startup, on_shutdown=on_shutdown)
+
+
+class WebhookServer:
+    """
+    HTTP-сервер, принимающий обновления от Telegram и раскладывающий их по воркерам.
+
+    Обновления шардируются по id пользователя, поэтому состояние FSM и дневные
+    счётчики пользователя всегда обрабатывает один и тот же процесс. Сервер отвечает
+    Telegram сразу после постановки обновления в очередь, ответы бот отправляет
+    из воркеров через Bot API.
+    """
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS):
+        self.workers = workers
+        context = multiprocessing.get_context("spawn")
+        self.queues: List[multiprocessing.Queue] = [context.Queue() for _ in range(workers)]
+        self.processes = [
+            context.Process(target=_worker_main, args=(index, workers, queue), name=f"bot-worker-{index}")
+            for index, queue in enumerate(self.queues)
+        ]
+        self.bot: Optional[Bot] = None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        raw = await request.text()
+        try:
+            user_id = update_user_id(json.loads(raw))
+        except ValueError:
+            return web.Response(status=400)
+        self.queues[shard_for(user_id, self.workers)].put_nowait(raw)
+        return web.Response()
+
+    async def on_startup(self, app: web.Application):
+        for process in self.processes:
+            process.start()
+        if WEBHOOK_HOST:
+            self.bot = Bot(token=os.getenv("BOT_TOKEN"))
+            await self.bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                                       drop_pending_updates=True)
+            logger.info("Webhook установлен: %s%s", WEBHOOK_HOST, WEBHOOK_PATH)
+
+    async def on_shutdown(self, app: web.Application):
+        for queue in self.queues:
+            queue.put(None)
+        loop = asyncio.get_event_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 30)
+        if self.bot is not None:
+            await (await self.bot.get_session()).close()
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
+
+
+def run_webhook(workers: int = WEBHOOK_WORKERS):
+    """Запускает webhook-сервер с заданным числом процессов-воркеров."""
+    server = WebhookServer(workers)
+    logger.info("Запуск webhook-сервера на %s:%s, воркеров: %s", WEBAPP_HOST, WEBAPP_PORT, workers)
+    web.run_app(server.create_app(), host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    from log_setup import setup_logging
+    setup_logging()
+    run_webhook()